@@ -0,0 +1,81 @@
+"""
+python benchmarks/pragmas.py
+"""
+
+import os
+import sys
+import tempfile
+import threading
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from pirouz import DB, columns  # noqa: E402
+from pirouz.orm import connections  # noqa: E402
+from pirouz.orm.connection import WAL_PRAGMAS  # noqa: E402
+
+WRITES = 2000
+READERS = 4
+READS = 500
+
+
+def run(pragmas: dict) -> tuple:
+    connections.close_all()
+    connections.configure(pragmas=pragmas)
+
+    class Entry(DB):
+        db_name = 'bench.db'
+        title = columns.Text()
+        score = columns.Integer(index=True)
+
+    start = time.perf_counter()
+    for number in range(WRITES):
+        Entry(title=f'entry {number}', score=number % 100)
+    writes = WRITES / (time.perf_counter() - start)
+
+    def reader():
+        for number in range(READS):
+            list(Entry.filter(score=number % 100).limit(10))
+
+    def writer():
+        while not done.is_set():
+            Entry(title='concurrent', score=0)
+
+    done = threading.Event()
+    threads = [threading.Thread(target=reader) for _ in range(READERS)]
+    background = threading.Thread(target=writer)
+    background.start()
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    reads = READERS * READS / (time.perf_counter() - start)
+    done.set()
+    background.join()
+    connections.close_all()
+    return writes, reads
+
+
+def main() -> None:
+    presets = {
+        'default': {'busy_timeout': 5000},
+        'wal': WAL_PRAGMAS,
+    }
+    cwd = os.getcwd()
+    for name, pragmas in presets.items():
+        with tempfile.TemporaryDirectory() as path:
+            os.chdir(path)
+            try:
+                writes, reads = run(pragmas)
+            finally:
+                os.chdir(cwd)
+        print(
+            f'{name:>8}: {writes:8.0f} inserts/s, '
+            f'{reads:8.0f} reads/s with a concurrent writer'
+        )
+
+
+if __name__ == '__main__':
+    main()
@@ -1,7 +1,10 @@
 from .wsgi import App
-from .response import TextResponse, Render, redirect
-from .middleware import BaseMiddleware
+from .response import TextResponse, Render, BlobResponse, redirect
+from .middleware import (
+    BaseMiddleware, QueryCountMiddleware, TransactionMiddleware,
+)
 from .orm import DB, ResultConfig
-from .orm.operators import AND, OR, NOT
+from .orm.operators import AND, OR, NOT, Q
+from .orm.expressions import F
 from .orm import columns
 from . import utils
@@ -1,5 +1,9 @@
+from werkzeug.exceptions import HTTPException
 from werkzeug.wrappers import Request
 
+from .orm.connection import connections
+from .orm.log import logger, query_log
+
 
 class BaseMiddleware:
     def __init__(self, app):
@@ -23,3 +27,26 @@ class BaseMiddleware:
 
     def process_response(self, request, response):
         return response
+
+
+class TransactionMiddleware(BaseMiddleware):
+    def dispatch(self, request):
+        with connections.transaction():
+            return super().dispatch(request)
+
+
+class QueryCountMiddleware(BaseMiddleware):
+    def dispatch(self, request):
+        with query_log.track() as counter:
+            response = super().dispatch(request)
+        if isinstance(response, HTTPException):
+            # routing exceptions such as redirects carry no headers yet
+            response = response.get_response(request.environ)
+        response.headers['X-Query-Count'] = str(counter.count)
+        response.headers['X-Query-Time'] = f'{counter.duration * 1000:.2f}'
+        logger.debug(
+            '%s %s ran %d queries in %.1fms',
+            request.method, request.path, counter.count,
+            counter.duration * 1000,
+        )
+        return response
@@ -1,3 +1,12 @@
-from .db import DB, ResultConfig
+from .db import DB, ResultConfig, StaleRowError
+from .connection import connections
+from .compiler import statements
+from .cache import results
+from .aio import executor
+from .log import query_log
+from .advisor import advisor
+from .replica import replicas
+from .writer import writer
 from . import columns
 from . import operators
+from .expressions import F
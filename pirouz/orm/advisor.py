@@ -0,0 +1,166 @@
+from __future__ import annotations
+import random
+import re
+import threading
+from contextlib import contextmanager
+from typing import Dict, Iterator, List, NamedTuple, Tuple, Union
+
+from .connection import connections
+
+SCAN = re.compile(r'^SCAN (?:TABLE )?(\w+)(?: AS (\w+))?$')
+EQUALITY = ('=', 'IN', 'IS')
+
+
+class QueryPlan(NamedTuple):
+    table: str
+    sql: str
+    details: Tuple[str, ...]
+    scans: Tuple[Tuple[str, Tuple[str, ...]], ...]
+
+
+class IndexSuggestion(NamedTuple):
+    table: str
+    columns: Tuple[str, ...]
+    rows: int
+    queries: int
+    executions: int
+    example: str
+
+    def format(self) -> str:
+        fields = ', '.join(repr(column) for column in self.columns)
+        return (f'{self.table}: columns.Index({fields}) -- '
+                f'{self.executions} runs of {self.queries} queries '
+                f'scanning ~{self.rows} rows')
+
+
+class QueryPlanAdvisor:
+    def __init__(self, min_rows: int = 1000,
+                 sample_rate: float = 1.0) -> None:
+        self.enabled = False
+        self.min_rows = min_rows
+        self.sample_rate = sample_rate
+        self._plans: Dict[Tuple[str, str], QueryPlan] = {}
+        self._executions: Dict[Tuple[str, str], int] = {}
+        self._rows: Dict[Tuple[str, str], int] = {}
+        self._lock = threading.Lock()
+
+    def configure(self, enabled: Union[bool, None] = None,
+                  min_rows: Union[int, None] = None,
+                  sample_rate: Union[float, None] = None) -> None:
+        if enabled is not None:
+            self.enabled = enabled
+        if min_rows is not None:
+            self.min_rows = min_rows
+        if sample_rate is not None:
+            self.sample_rate = sample_rate
+
+    @contextmanager
+    def profile(self, **options) -> Iterator[QueryPlanAdvisor]:
+        enabled = self.enabled
+        self.configure(enabled=True, **options)
+        try:
+            yield self
+        finally:
+            self.enabled = enabled
+
+    def observe(self, model: type, query: str, params: tuple) -> None:
+        if not query.startswith('SELECT '):
+            return
+        if self.sample_rate < 1 and random.random() >= self.sample_rate:
+            return
+        key = (model.db_name, query)
+        with self._lock:
+            self._executions[key] = self._executions.get(key, 0) + 1
+            if key in self._plans:
+                return
+        # every distinct statement is explained once per window
+        plan = self.explain(model, query, params)
+        with self._lock:
+            self._plans[key] = plan
+
+    def explain(self, model: type, query: str, params: tuple) -> QueryPlan:
+        with connections.connection(model.db_name) as conn:
+            rows = conn.execute(f'EXPLAIN QUERY PLAN {query}', params)
+            details = tuple(row[3] for row in rows)
+        scans = []
+        for detail in details:
+            match = SCAN.match(detail)
+            if match is None:
+                continue
+            table, alias = match.groups()
+            rows = self._table_rows(model.db_name, table)
+            if rows < self.min_rows:
+                continue
+            scans.append((table, self._columns(query, alias or table)))
+        return QueryPlan(model.table_name, query, details, tuple(scans))
+
+    def plans(self) -> List[QueryPlan]:
+        with self._lock:
+            return list(self._plans.values())
+
+    def report(self) -> List[IndexSuggestion]:
+        suggestions: Dict[Tuple[str, str, Tuple[str, ...]], list] = {}
+        with self._lock:
+            for key, plan in self._plans.items():
+                for table, columns in plan.scans:
+                    if not columns:
+                        continue
+                    suggestion = suggestions.setdefault(
+                        (key[0], table, columns),
+                        [self._rows[(key[0], table)], 0, 0, plan.sql],
+                    )
+                    suggestion[1] += 1
+                    suggestion[2] += self._executions[key]
+        report = [
+            IndexSuggestion(table, columns, *values)
+            for (_, table, columns), values in suggestions.items()
+        ]
+        report.sort(key=lambda suggestion: (
+            -suggestion.executions, suggestion.table,
+        ))
+        return report
+
+    def format_report(self) -> str:
+        return '\n'.join(suggestion.format() for suggestion in self.report())
+
+    def clear(self) -> None:
+        with self._lock:
+            self._plans.clear()
+            self._executions.clear()
+            self._rows.clear()
+
+    def _table_rows(self, database: str, table: str) -> int:
+        key = (database, table)
+        with self._lock:
+            if key in self._rows:
+                return self._rows[key]
+        # max(rowid) is a single b-tree seek, close enough to a count
+        with connections.connection(database) as conn:
+            rows = conn.execute(f'SELECT MAX(rowid) FROM {table};')
+            count = rows.fetchone()[0] or 0
+        with self._lock:
+            self._rows[key] = count
+        return count
+
+    @staticmethod
+    def _columns(query: str, table: str) -> Tuple[str, ...]:
+        # ORM statements always qualify columns, so equality lookups,
+        # then ranges, then the ordering make up the suggested index
+        where, _, order_by = query.partition(' ORDER BY ')
+        conditions = re.findall(
+            rf'\b{table}\.(\w+) (=|<=|>=|<|>|IN|IS|BETWEEN) ',
+            where.partition(' WHERE ')[2],
+        )
+        columns: List[str] = []
+        for column, operator in sorted(
+                conditions, key=lambda item: item[1] not in EQUALITY):
+            if column != 'id' and column not in columns:
+                columns.append(column)
+        for column in re.findall(rf'\b{table}\.(\w+) (?:ASC|DESC)',
+                                 order_by):
+            if column != 'id' and column not in columns:
+                columns.append(column)
+        return tuple(columns)
+
+
+advisor = QueryPlanAdvisor()
@@ -0,0 +1,64 @@
+from __future__ import annotations
+import asyncio
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from typing import Any, Callable, Union
+
+
+class AsyncExecutor:
+    def __init__(self, readers: int = 4) -> None:
+        self.readers = readers
+        self._reader = None
+        self._writer = None
+        self._lock = threading.Lock()
+        self._pid = os.getpid()
+
+    def configure(self, readers: Union[int, None] = None) -> None:
+        if readers is not None:
+            self.readers = readers
+        self.shutdown()
+
+    async def read(self, func: Callable, *args, **kwargs) -> Any:
+        return await self._run(self._executors()[0], func, args, kwargs)
+
+    async def write(self, func: Callable, *args, **kwargs) -> Any:
+        # every write goes through one thread, so sqlite never sees two
+        # writers from the same worker competing for the lock
+        return await self._run(self._executors()[1], func, args, kwargs)
+
+    def shutdown(self) -> None:
+        with self._lock:
+            reader, self._reader = self._reader, None
+            writer, self._writer = self._writer, None
+        for executor in (reader, writer):
+            if executor is not None:
+                executor.shutdown(wait=False)
+
+    async def _run(self, executor: ThreadPoolExecutor, func: Callable,
+                   args: tuple, kwargs: dict) -> Any:
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(
+            executor, partial(func, *args, **kwargs),
+        )
+
+    def _executors(self):
+        with self._lock:
+            if self._pid != os.getpid():
+                # thread pools don't survive a fork
+                self._reader = self._writer = None
+                self._pid = os.getpid()
+            if self._reader is None:
+                self._reader = ThreadPoolExecutor(
+                    max_workers=self.readers,
+                    thread_name_prefix='pirouz-db-reader',
+                )
+                self._writer = ThreadPoolExecutor(
+                    max_workers=1,
+                    thread_name_prefix='pirouz-db-writer',
+                )
+            return self._reader, self._writer
+
+
+executor = AsyncExecutor()
@@ -0,0 +1,230 @@
+from __future__ import annotations
+import os
+import sqlite3
+import sys
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Dict, Hashable, List, NamedTuple, Tuple, Union
+
+VERSIONS_TABLE = 'pirouz_versions'
+
+
+class ResultCacheStats(NamedTuple):
+    hits: int = 0
+    misses: int = 0
+    evictions: int = 0
+    entries: int = 0
+    bytes: int = 0
+
+    @property
+    def hit_rate(self) -> float:
+        total = self.hits + self.misses
+        if not total:
+            return 0.0
+        return self.hits / total
+
+
+class TableVersions:
+    def __init__(self, database: str) -> None:
+        self.database = database
+        self.data_version = None
+        self.versions: Dict[str, int] = {}
+        self._conn = None
+        self._lock = threading.Lock()
+
+    def current(self, tables: Tuple[str, ...]) -> Tuple[int, ...]:
+        with self._lock:
+            if self._conn is None:
+                self._conn = sqlite3.connect(
+                    self.database,
+                    isolation_level=None,
+                    check_same_thread=False,
+                )
+            # data_version moves whenever another connection, in this
+            # process or another worker, commits to the database.
+            conn = self._conn
+            data_version = conn.execute('PRAGMA data_version;').fetchone()[0]
+            if data_version != self.data_version:
+                try:
+                    rows = conn.execute(
+                        f'SELECT name, version FROM {VERSIONS_TABLE};'
+                    ).fetchall()
+                except sqlite3.OperationalError:
+                    rows = []
+                self.versions = dict(rows)
+                self.data_version = data_version
+            return tuple(self.versions.get(table, 0) for table in tables)
+
+    def close(self) -> None:
+        with self._lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
+
+
+class ResultCache:
+    def __init__(self, max_entries: int = 1024,
+                 max_bytes: int = 32 * 1024 * 1024,
+                 ttl: Union[float, None] = 60.0) -> None:
+        self.enabled = False
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.bytes = 0
+        self._entries: OrderedDict[Hashable, tuple] = OrderedDict()
+        self._versions: Dict[str, TableVersions] = {}
+        self._created: set = set()
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._pid = os.getpid()
+
+    def configure(self, enabled: Union[bool, None] = None,
+                  max_entries: Union[int, None] = None,
+                  max_bytes: Union[int, None] = None,
+                  ttl: Union[float, None, bool] = False) -> None:
+        # `ttl=None` keeps entries until invalidated, so `False` means
+        # unchanged
+        if enabled is not None:
+            self.enabled = enabled
+        if max_entries is not None:
+            self.max_entries = max_entries
+        if max_bytes is not None:
+            self.max_bytes = max_bytes
+        if ttl is not False:
+            self.ttl = ttl
+        self.clear()
+
+    def lookup(self, database: str, query: str, params: tuple,
+               tables: Tuple[str, ...],
+               in_transaction: bool) -> Tuple[bool, Any, Any]:
+        # returns (hit, rows, token), the token is what `store` needs to
+        # tag a new entry with the table versions it was read at.
+        dirty = self._dirty()
+        if not in_transaction:
+            dirty.clear()
+        elif dirty.intersection(tables):
+            return False, None, None
+        self._check_fork()
+        database = os.path.abspath(database)
+        versions = self._table_versions(database).current(tables)
+        key = (database, query, params)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                entry_versions, expires_at, rows, size = entry
+                if entry_versions == versions and (
+                        expires_at is None or expires_at > time.monotonic()):
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return True, rows, None
+                del self._entries[key]
+                self.bytes -= size
+            self.misses += 1
+        if in_transaction:
+            # results read inside a transaction may come from an older
+            # snapshot, so they are served but never stored.
+            return False, None, None
+        return False, None, (key, versions)
+
+    def store(self, token: Any, rows: Any) -> None:
+        if token is None:
+            return
+        key, versions = token
+        size = self._size(rows)
+        if size > self.max_bytes:
+            return
+        expires_at = None
+        if self.ttl is not None:
+            expires_at = time.monotonic() + self.ttl
+        with self._lock:
+            previous = self._entries.pop(key, None)
+            if previous is not None:
+                self.bytes -= previous[3]
+            self._entries[key] = (versions, expires_at, rows, size)
+            self.bytes += size
+            while (len(self._entries) > self.max_entries or
+                   self.bytes > self.max_bytes):
+                _, entry = self._entries.popitem(last=False)
+                self.bytes -= entry[3]
+                self.evictions += 1
+
+    def touch(self, conn: sqlite3.Connection, database: str,
+              table: str) -> None:
+        database = os.path.abspath(database)
+        if database not in self._created:
+            conn.execute(
+                f'CREATE TABLE IF NOT EXISTS {VERSIONS_TABLE} '
+                '(name TEXT PRIMARY KEY, version INTEGER NOT NULL);'
+            )
+            self._created.add(database)
+        conn.execute(
+            f'INSERT INTO {VERSIONS_TABLE} (name, version) VALUES (?, 1) '
+            'ON CONFLICT (name) DO UPDATE SET version = version + 1;',
+            (table,),
+        )
+        # until the surrounding transaction ends, its own reads of this
+        # table must bypass the cache
+        self._dirty().add(table)
+
+    def stats(self) -> ResultCacheStats:
+        with self._lock:
+            return ResultCacheStats(
+                hits=self.hits,
+                misses=self.misses,
+                evictions=self.evictions,
+                entries=len(self._entries),
+                bytes=self.bytes,
+            )
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+            self.bytes = 0
+            self.hits = 0
+            self.misses = 0
+            self.evictions = 0
+            versions, self._versions = self._versions, {}
+            self._created = set()
+        for table_versions in versions.values():
+            table_versions.close()
+
+    def _table_versions(self, database: str) -> TableVersions:
+        with self._lock:
+            table_versions = self._versions.get(database)
+            if table_versions is None:
+                table_versions = TableVersions(database)
+                self._versions[database] = table_versions
+            return table_versions
+
+    def _dirty(self) -> set:
+        dirty = getattr(self._local, 'dirty', None)
+        if dirty is None:
+            dirty = self._local.dirty = set()
+        return dirty
+
+    def _check_fork(self) -> None:
+        if self._pid != os.getpid():
+            with self._lock:
+                self._entries.clear()
+                self._versions = {}
+                self.bytes = 0
+                self._pid = os.getpid()
+
+    @staticmethod
+    def _size(rows: Union[List[tuple], tuple, None]) -> int:
+        if rows is None:
+            return sys.getsizeof(rows)
+        if isinstance(rows, tuple):
+            rows = [rows]
+        size = sys.getsizeof(rows)
+        for row in rows:
+            size += sys.getsizeof(row)
+            size += sum(sys.getsizeof(value) for value in row)
+        return size
+
+
+results = ResultCache()
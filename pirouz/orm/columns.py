@@ -1,13 +1,28 @@
-from typing import Union
+from typing import Tuple, Union
+
+# array.array typecodes for columns whose values fit a fixed-width type
+TYPECODES = {
+    'INT': 'q',
+    'INTEGER': 'q',
+    'TINYINT': 'q',
+    'SMALLINT': 'q',
+    'MEDIUMINT': 'q',
+    'BOOLEAN': 'q',
+    'REAL': 'd',
+    'DOUBLE': 'd',
+    'FLOAT': 'd',
+}
 
 
 class Column:
     def __init__(self, unique: bool = False,
-                 nullable: bool = True, default: str = None) -> None:
+                 nullable: bool = True, default: str = None,
+                 index: bool = False) -> None:
         self.type = None
         self.unique = unique
         self.nullable = nullable
         self.default = default
+        self.index = index
 
     def __repr__(self):
         constraints = ''
@@ -23,128 +38,176 @@ class Column:
 
 class Int(Column):
     def __init__(self, unique: bool = False,
-                 nullable: bool = True, default: str = None) -> None:
-        super().__init__(unique, nullable, default)
+                 nullable: bool = True, default: str = None,
+                 index: bool = False) -> None:
+        super().__init__(unique, nullable, default, index)
         self.type = 'INT'
 
 
 class Integer(Column):
     def __init__(self, unique: bool = False,
-                 nullable: bool = True, default: str = None) -> None:
-        super().__init__(unique, nullable, default)
+                 nullable: bool = True, default: str = None,
+                 index: bool = False) -> None:
+        super().__init__(unique, nullable, default, index)
         self.type = 'INTEGER'
 
 
 class TinyInt(Column):
     def __init__(self, unique: bool = False,
-                 nullable: bool = True, default: str = None) -> None:
-        super().__init__(unique, nullable, default)
+                 nullable: bool = True, default: str = None,
+                 index: bool = False) -> None:
+        super().__init__(unique, nullable, default, index)
         self.type = 'TINYINT'
 
 
 class SmallInt(Column):
     def __init__(self, unique: bool = False,
-                 nullable: bool = True, default: str = None) -> None:
-        super().__init__(unique, nullable, default)
+                 nullable: bool = True, default: str = None,
+                 index: bool = False) -> None:
+        super().__init__(unique, nullable, default, index)
         self.type = 'SMALLINT'
 
 
 class MediumInt(Column):
     def __init__(self, unique: bool = False,
-                 nullable: bool = True, default: str = None) -> None:
-        super().__init__(unique, nullable, default)
+                 nullable: bool = True, default: str = None,
+                 index: bool = False) -> None:
+        super().__init__(unique, nullable, default, index)
         self.type = 'MEDIUMINT'
 
 
 class Text(Column):
     def __init__(self, unique: bool = False,
-                 nullable: bool = True, default: str = None) -> None:
-        super().__init__(unique, nullable, default)
+                 nullable: bool = True, default: str = None,
+                 index: bool = False) -> None:
+        super().__init__(unique, nullable, default, index)
         self.type = 'TEXT'
 
 
 class VarChar(Column):
     def __init__(self, unique: bool = False,
-                 nullable: bool = True, default: str = None) -> None:
-        super().__init__(unique, nullable, default)
+                 nullable: bool = True, default: str = None,
+                 index: bool = False) -> None:
+        super().__init__(unique, nullable, default, index)
         self.type = 'VARCHAR(255)'
 
 
 class Blob(Column):
     def __init__(self, unique: bool = False,
-                 nullable: bool = True, default: str = None) -> None:
-        super().__init__(unique, nullable, default)
+                 nullable: bool = True, default: str = None,
+                 index: bool = False) -> None:
+        super().__init__(unique, nullable, default, index)
         self.type = 'BLOB'
 
 
 class Real(Column):
     def __init__(self, unique: bool = False,
-                 nullable: bool = True, default: str = None) -> None:
-        super().__init__(unique, nullable, default)
+                 nullable: bool = True, default: str = None,
+                 index: bool = False) -> None:
+        super().__init__(unique, nullable, default, index)
         self.type = 'REAL'
 
 
 class Double(Column):
     def __init__(self, unique: bool = False,
-                 nullable: bool = True, default: str = None) -> None:
-        super().__init__(unique, nullable, default)
+                 nullable: bool = True, default: str = None,
+                 index: bool = False) -> None:
+        super().__init__(unique, nullable, default, index)
         self.type = 'DOUBLE'
 
 
 class Float(Column):
     def __init__(self, unique: bool = False,
-                 nullable: bool = True, default: str = None) -> None:
-        super().__init__(unique, nullable, default)
+                 nullable: bool = True, default: str = None,
+                 index: bool = False) -> None:
+        super().__init__(unique, nullable, default, index)
         self.type = 'FLOAT'
 
 
 class Numeric(Column):
     def __init__(self, unique: bool = False,
-                 nullable: bool = True, default: str = None) -> None:
-        super().__init__(unique, nullable, default)
+                 nullable: bool = True, default: str = None,
+                 index: bool = False) -> None:
+        super().__init__(unique, nullable, default, index)
         self.type = 'NUMERIC'
 
 
 class Decimal(Column):
     def __init__(self, unique: bool = False,
-                 nullable: bool = True, default: str = None) -> None:
-        super().__init__(unique, nullable, default)
+                 nullable: bool = True, default: str = None,
+                 index: bool = False) -> None:
+        super().__init__(unique, nullable, default, index)
         self.type = 'DECIMAL(10,5)'
 
 
 class Boolean(Column):
     def __init__(self, unique: bool = False,
-                 nullable: bool = True, default: str = None) -> None:
-        super().__init__(unique, nullable, default)
+                 nullable: bool = True, default: str = None,
+                 index: bool = False) -> None:
+        super().__init__(unique, nullable, default, index)
         self.type = 'BOOLEAN'
 
 
 class Date(Column):
     def __init__(self, unique: bool = False,
-                 nullable: bool = True, default: str = None) -> None:
-        super().__init__(unique, nullable, default)
+                 nullable: bool = True, default: str = None,
+                 index: bool = False) -> None:
+        super().__init__(unique, nullable, default, index)
         self.type = 'DATE'
 
 
 class DateTime(Column):
     def __init__(self, unique: bool = False,
-                 nullable: bool = True, default: str = None) -> None:
-        super().__init__(unique, nullable, default)
+                 nullable: bool = True, default: str = None,
+                 index: bool = False) -> None:
+        super().__init__(unique, nullable, default, index)
         self.type = 'DATETIME'
 
 
+class Version(Column):
+    def __init__(self) -> None:
+        super().__init__(nullable=True, default=0)
+        self.type = 'INTEGER'
+
+
 class ForeignKey(Column):
     def __set_name__(self, owner, name):
         self.column_name_ = name
 
     def __init__(self, reference: Union[object, str], unique: bool = False,
-                 nullable: bool = True, default: str = None) -> None:
-        super().__init__(unique, nullable, default)
+                 nullable: bool = True, default: str = None,
+                 index: bool = False) -> None:
+        super().__init__(unique, nullable, default, index)
         self.type = 'INTEGER'
-        if isinstance(reference, object):
+        if not isinstance(reference, str):
             reference = reference.__name__
         self.reference = reference.lower()
 
     def get_foreign_key(self):
         name = self.column_name_
         return f'FOREIGN KEY ({name}) REFERENCES {self.reference} (id)'
+
+
+class Index:
+    def __init__(self, *fields: str, unique: bool = False,
+                 where: Union[str, None] = None) -> None:
+        self.fields: Tuple[str, ...] = tuple(
+            field.lower() for field in fields
+        )
+        self.unique = unique
+        self.where = where
+
+    def get_name(self, table_name: str) -> str:
+        prefix = 'ux' if self.unique else 'ix'
+        return f'{prefix}_{table_name}_{"_".join(self.fields)}'
+
+    def get_statement(self, table_name: str) -> str:
+        unique = 'UNIQUE ' if self.unique else ''
+        fields = ', '.join(self.fields)
+        statement = (
+            f'CREATE {unique}INDEX {self.get_name(table_name)} '
+            f'ON {table_name} ({fields})'
+        )
+        if self.where:
+            statement += f' WHERE {self.where}'
+        return statement
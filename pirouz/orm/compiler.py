@@ -0,0 +1,60 @@
+from __future__ import annotations
+import threading
+from collections import OrderedDict
+from typing import Callable, Hashable, NamedTuple
+
+
+class CacheStats(NamedTuple):
+    hits: int = 0
+    misses: int = 0
+    size: int = 0
+    maxsize: int = 0
+
+    @property
+    def hit_rate(self) -> float:
+        total = self.hits + self.misses
+        if not total:
+            return 0.0
+        return self.hits / total
+
+
+class StatementCache:
+    def __init__(self, maxsize: int = 512) -> None:
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._statements: OrderedDict[Hashable, str] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, shape: Hashable, build: Callable[[], str]) -> str:
+        with self._lock:
+            query = self._statements.get(shape)
+            if query is not None:
+                self._statements.move_to_end(shape)
+                self.hits += 1
+                return query
+            self.misses += 1
+        query = build()
+        with self._lock:
+            self._statements[shape] = query
+            if len(self._statements) > self.maxsize:
+                self._statements.popitem(last=False)
+        return query
+
+    def stats(self) -> CacheStats:
+        with self._lock:
+            return CacheStats(
+                hits=self.hits,
+                misses=self.misses,
+                size=len(self._statements),
+                maxsize=self.maxsize,
+            )
+
+    def clear(self) -> None:
+        with self._lock:
+            self._statements.clear()
+            self.hits = 0
+            self.misses = 0
+
+
+statements = StatementCache()
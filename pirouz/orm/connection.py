@@ -0,0 +1,310 @@
+from __future__ import annotations
+import os
+import re
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+from typing import Any, Dict, Iterator, List, NamedTuple, Tuple, Union
+
+PRAGMAS = (
+    'journal_mode',
+    'synchronous',
+    'mmap_size',
+    'cache_size',
+    'temp_store',
+    'busy_timeout',
+    'foreign_keys',
+    'wal_autocheckpoint',
+)
+WAL_PRAGMAS = {
+    'journal_mode': 'wal',
+    'synchronous': 'normal',
+    'mmap_size': 256 * 1024 * 1024,
+    'cache_size': -64 * 1024,
+    'temp_store': 'memory',
+    'busy_timeout': 5000,
+}
+
+
+def check_pragmas(pragmas: Dict[str, Any]) -> Dict[str, Any]:
+    for name, value in pragmas.items():
+        if name not in PRAGMAS:
+            raise ValueError(f'Unsupported pragma `{name}`!')
+        if not re.fullmatch(r'-?\w+', str(value)):
+            raise ValueError(f'Invalid value {value!r} for pragma `{name}`!')
+    return dict(pragmas)
+
+
+class PoolStats(NamedTuple):
+    hits: int = 0
+    misses: int = 0
+    recycled: int = 0
+    discarded: int = 0
+    idle: int = 0
+    in_use: int = 0
+
+
+class ConnectionPool:
+    def __init__(self, database: str, size: int = 5,
+                 recycle: Union[float, None] = 300.0,
+                 cached_statements: int = 256,
+                 pragmas: Union[Dict[str, Any], None] = None) -> None:
+        self.database = database
+        self.size = size
+        self.recycle = recycle
+        self.cached_statements = cached_statements
+        self.pragmas = pragmas or {}
+        self.hits = 0
+        self.misses = 0
+        self.recycled = 0
+        self.discarded = 0
+        self.in_use = 0
+        self._idle: List[Tuple[sqlite3.Connection, float]] = []
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    def connect(self) -> sqlite3.Connection:
+        # transactions are managed explicitly, so connections run in
+        # autocommit mode and may move between threads of the pool.
+        conn = sqlite3.connect(
+            self.database,
+            isolation_level=None,
+            check_same_thread=False,
+            cached_statements=self.cached_statements,
+        )
+        for name, value in self.pragmas.items():
+            conn.execute(f'PRAGMA {name} = {value};')
+        return conn
+
+    def acquire(self) -> sqlite3.Connection:
+        pinned = self.pinned()
+        if pinned is not None:
+            return pinned
+        now = time.monotonic()
+        expired = []
+        conn = None
+        with self._lock:
+            while self._idle:
+                candidate, released_at = self._idle.pop()
+                if (self.recycle is not None and
+                        now - released_at > self.recycle):
+                    expired.append(candidate)
+                    self.recycled += 1
+                    continue
+                conn = candidate
+                self.hits += 1
+                break
+            else:
+                self.misses += 1
+            self.in_use += 1
+        for candidate in expired:
+            candidate.close()
+        if conn is None:
+            try:
+                conn = self.connect()
+            except Exception:
+                with self._lock:
+                    self.in_use -= 1
+                raise
+        return conn
+
+    def release(self, conn: sqlite3.Connection) -> None:
+        if conn is self.pinned():
+            return
+        if conn.in_transaction:
+            conn.rollback()
+        with self._lock:
+            self.in_use -= 1
+            if len(self._idle) < self.size:
+                self._idle.append((conn, time.monotonic()))
+                return
+            self.discarded += 1
+        conn.close()
+
+    def pin(self, conn: sqlite3.Connection) -> None:
+        self._local.connection = conn
+
+    def unpin(self) -> Union[sqlite3.Connection, None]:
+        conn = self.pinned()
+        self._local.connection = None
+        return conn
+
+    def pinned(self) -> Union[sqlite3.Connection, None]:
+        return getattr(self._local, 'connection', None)
+
+    def stats(self) -> PoolStats:
+        with self._lock:
+            return PoolStats(
+                hits=self.hits,
+                misses=self.misses,
+                recycled=self.recycled,
+                discarded=self.discarded,
+                idle=len(self._idle),
+                in_use=self.in_use,
+            )
+
+    def close(self) -> None:
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for conn, _ in idle:
+            conn.close()
+
+
+class ConnectionManager:
+    def __init__(self, size: int = 5,
+                 recycle: Union[float, None] = 300.0,
+                 cached_statements: int = 256) -> None:
+        self.size = size
+        self.recycle = recycle
+        self.cached_statements = cached_statements
+        self.pragmas: Dict[str, Any] = {}
+        self._database_pragmas: Dict[str, Dict[str, Any]] = {}
+        self._pools: Dict[str, ConnectionPool] = {}
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._pid = os.getpid()
+
+    def configure(self, size: Union[int, None] = None,
+                  recycle: Union[float, None, bool] = False,
+                  cached_statements: Union[int, None] = None,
+                  pragmas: Union[Dict[str, Any], None] = None) -> None:
+        # `recycle=None` disables idle recycling, so `False` means unchanged
+        if size is not None:
+            self.size = size
+        if recycle is not False:
+            self.recycle = recycle
+        if cached_statements is not None:
+            self.cached_statements = cached_statements
+        if pragmas is not None:
+            self.pragmas = check_pragmas(pragmas)
+        self._reconfigure()
+
+    def configure_database(self, db_name: str,
+                           pragmas: Dict[str, Any]) -> None:
+        database = os.path.abspath(db_name)
+        self._database_pragmas[database] = check_pragmas(pragmas)
+        self._reconfigure()
+
+    def _reconfigure(self) -> None:
+        with self._lock:
+            pools = list(self._pools.values())
+        for pool in pools:
+            pool.size = self.size
+            pool.recycle = self.recycle
+            pool.cached_statements = self.cached_statements
+            pool.pragmas = self._pragmas(pool.database)
+            # idle connections were opened with the old settings
+            pool.close()
+
+    def _pragmas(self, database: str) -> Dict[str, Any]:
+        return {
+            **self.pragmas,
+            **self._database_pragmas.get(database, {}),
+        }
+
+    def pool(self, db_name: str) -> ConnectionPool:
+        database = os.path.abspath(db_name)
+        with self._lock:
+            if self._pid != os.getpid():
+                # a forked worker must never reuse the parent's sqlite
+                # handles, so drop them without closing.
+                self._pools = {}
+                self._pid = os.getpid()
+            pool = self._pools.get(database)
+            if pool is None:
+                pool = ConnectionPool(
+                    database, self.size, self.recycle,
+                    self.cached_statements, self._pragmas(database),
+                )
+                self._pools[database] = pool
+            return pool
+
+    @contextmanager
+    def connection(self, db_name: str) -> Iterator[sqlite3.Connection]:
+        pool = self.pool(db_name)
+        depth = getattr(self._local, 'depth', 0)
+        if depth and pool.pinned() is None:
+            self._join_transaction(pool, depth)
+        conn = pool.acquire()
+        try:
+            yield conn
+        finally:
+            pool.release(conn)
+
+    @contextmanager
+    def transaction(self, immediate: bool = False) -> Iterator[None]:
+        local = self._local
+        depth = getattr(local, 'depth', 0) + 1
+        if depth == 1:
+            local.pools = []
+            local.immediate = immediate
+        else:
+            for pool in local.pools:
+                pool.pinned().execute(f'SAVEPOINT pirouz_{depth};')
+        local.depth = depth
+        try:
+            yield
+        except BaseException:
+            self._end_transaction(depth, commit=False)
+            raise
+        else:
+            self._end_transaction(depth, commit=True)
+
+    def in_transaction(self) -> bool:
+        return getattr(self._local, 'depth', 0) > 0
+
+    def _join_transaction(self, pool: ConnectionPool, depth: int) -> None:
+        # databases are enlisted lazily, on their first statement inside
+        # the block, and catch up with the savepoints opened so far.
+        conn = pool.acquire()
+        try:
+            if self._local.immediate:
+                conn.execute('BEGIN IMMEDIATE;')
+            else:
+                conn.execute('BEGIN;')
+            for level in range(2, depth + 1):
+                conn.execute(f'SAVEPOINT pirouz_{level};')
+        except BaseException:
+            pool.release(conn)
+            raise
+        pool.pin(conn)
+        self._local.pools.append(pool)
+
+    def _end_transaction(self, depth: int, commit: bool) -> None:
+        local = self._local
+        local.depth = depth - 1
+        if depth > 1:
+            for pool in local.pools:
+                conn = pool.pinned()
+                if not commit:
+                    conn.execute(f'ROLLBACK TO pirouz_{depth};')
+                conn.execute(f'RELEASE pirouz_{depth};')
+            return
+        pools, local.pools = local.pools, []
+        error = None
+        for pool in pools:
+            conn = pool.unpin()
+            try:
+                if commit and error is None:
+                    conn.execute('COMMIT;')
+                else:
+                    conn.execute('ROLLBACK;')
+            except sqlite3.Error as exc:
+                error = error or exc
+            finally:
+                pool.release(conn)
+        if error is not None:
+            raise error
+
+    def stats(self, db_name: str) -> PoolStats:
+        return self.pool(db_name).stats()
+
+    def close_all(self) -> None:
+        with self._lock:
+            pools, self._pools = self._pools, {}
+        for pool in pools.values():
+            pool.close()
+
+
+connections = ConnectionManager()
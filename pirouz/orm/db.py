@@ -1,10 +1,32 @@
 from __future__ import annotations
+import io
 import os
 import sqlite3
 import inspect
-from typing import Dict, List, NamedTuple, Tuple, Union
-from .operators import OPERATORS
-from .columns import ForeignKey
+import threading
+import time
+from array import array
+from concurrent.futures import Future
+from contextlib import contextmanager
+from functools import partial
+from hashlib import sha256
+from itertools import groupby
+from typing import (
+    Any, BinaryIO, Callable, Dict, Iterable, Iterator, List, NamedTuple,
+    Tuple, Union,
+)
+from .columns import Column, ForeignKey, Index, Version
+from .advisor import advisor
+from .aio import executor
+from .cache import VERSIONS_TABLE, results
+from .compiler import statements
+from .connection import connections
+from .log import query_log
+from .replica import CHANGES_TABLE, KEPT_CHANGES, replicas
+from .writer import writer
+from .query import QuerySet
+
+SCHEMA_TABLE = 'pirouz_schema'
 
 
 class GenerateTableName:
@@ -25,8 +47,8 @@ class GetColumns:
         return (
             (key, value)
             for key, value in class_variables.items()
-            # remove python magic method from class variables
-            if not key.startswith('_')
+            # only column declarations, not methods or model options
+            if isinstance(value, Column)
         )
 
     def __get__(self, instance, owner) -> Dict[str, str]:
@@ -57,79 +79,136 @@ class GetForeignKeys:
 
 
 class Row:
-    def __init__(self, db_name_: str, table_name_: str, **data):
-        self.data = data
-        for key, value in data.items():
-            self.__setattr__(key, value)
-        Row.db_name = db_name_
-        Row.table_name = table_name_
+    __slots__ = ('_values', '_related', '_deferred')
+    _model: type = None
+    _fields: Tuple[str, ...] = ()
+    _deferred_fields: Tuple[str, ...] = ()
 
-    def remove(self):
-        where = ' AND '.join([
-            f'{key} = {repr(value)}'
-            for key, value in self.data.items()
-        ])
-        query = f'DELETE FROM {self.table_name} WHERE {where}'
-        self._execute(query)
+    def __init__(self, values: tuple):
+        self._values = values
+        self._related = None
+        self._deferred = None
 
-    def update(self, **kwargs):
-        where = ' AND '.join([
-            f'{key} = {repr(value)}'
-            for key, value in self.data.items()
-        ])
-        new_data = ', '.join([
-            f'{key} = {repr(value)}'
-            for key, value in kwargs.items()
-        ])
-        if new_data.strip():
-            query = (
-                f'UPDATE {self.table_name} SET {new_data} WHERE {where}'
+    @classmethod
+    def build(cls, model: type, fields: Tuple[str, ...]) -> type:
+        deferred = ()
+        if 'id' in fields:
+            # without the id, skipped columns can't be looked up later
+            deferred = tuple(
+                field for field in model.columns if field not in fields
             )
-            self._execute(query)
+        namespace = {
+            '__slots__': (),
+            '_model': model,
+            '_fields': fields,
+            '_deferred_fields': deferred,
+        }
+        for field in (*fields, *deferred):
+            if hasattr(cls, field):
+                raise ValueError(
+                    f'Column `{field}` of {model.__name__} would shadow '
+                    f'`Row.{field}`!'
+                )
+        for index, field in enumerate(fields):
+            namespace[field] = cls._field(index)
+        for field in deferred:
+            namespace[field] = cls._deferred_field(field)
+        return type(f'{model.__name__}Row', (cls,), namespace)
 
-    @ classmethod
-    def _execute(cls, query: str):
-        conn = sqlite3.connect(cls.db_name)
-        conn.execute(query)
-        conn.commit()
-        conn.close()
+    @staticmethod
+    def _field(index: int) -> property:
+        def getter(self):
+            return self._values[index]
 
-    def __repr__(self) -> str:
-        result = ', '.join([
-            f'{repr(attr)}:{repr(value)}'
-            for attr, value in self.data.items()
-        ])
-        return f"<{result}>"
+        def setter(self, value):
+            values = self._values
+            self._values = (*values[:index], value, *values[index + 1:])
+        return property(getter, setter)
 
+    @staticmethod
+    def _deferred_field(name: str) -> property:
+        def getter(self):
+            deferred = self._deferred
+            if deferred is None or name not in deferred:
+                self._set_deferred(name, self._model._load_deferred(
+                    name, self._values[self._fields.index('id')],
+                ))
+            return self._deferred[name]
 
-class Rows:
-    def __init__(self, rows: List[Row]):
-        self.rows = rows
+        def setter(self, value):
+            self._set_deferred(name, value)
+        return property(getter, setter)
 
-    def count(self) -> int:
-        return len(self.rows)
+    def _set_deferred(self, name: str, value: Any):
+        if self._deferred is None:
+            self._deferred = {}
+        self._deferred[name] = value
 
-    def first(self) -> Union[Row, None]:
-        if self.rows:
-            return self.rows[0]
-        return None
+    @property
+    def data(self) -> dict:
+        return dict(zip(self._fields, self._values))
 
-    def last(self) -> Union[Row, None]:
-        if self.rows:
-            return self.rows[-1]
-        return None
+    @property
+    def db_name(self) -> str:
+        return self._model.db_name
 
-    def __repr__(self) -> str:
-        return repr(self.rows)
+    @property
+    def table_name(self) -> str:
+        return self._model.table_name
+
+    def related(self, name: str) -> Union[Row, None]:
+        related = self._related
+        if related is None or name not in related:
+            model = self._model._related_model(name)
+            value = getattr(self, name)
+            row = None
+            if value is not None:
+                row = model.filter(id=value).first()
+            self._set_related(name, row)
+        return self._related[name]
+
+    async def aremove(self):
+        await executor.write(self.remove)
+
+    async def aupdate(self, **kwargs):
+        await executor.write(partial(self.update, **kwargs))
+
+    def _set_related(self, name: str, row: Union[Row, None]):
+        if self._related is None:
+            self._related = {}
+        self._related[name] = row
+
+    def remove(self):
+        self._model._remove_row(self.data)
 
-    def __iter__(self) -> List[Row]:
-        return iter(self.rows)
+    def update(self, **kwargs):
+        data = self._model._update_row(self.data, kwargs)
+        self._values = tuple(
+            data.get(field, value)
+            for field, value in zip(self._fields, self._values)
+        )
+        for field in self._deferred_fields:
+            if field in data:
+                self._set_deferred(field, data[field])
+
+    def __repr__(self) -> str:
+        result = ', '.join([
+            f'{repr(attr)}:{repr(value)}'
+            for attr, value in zip(self._fields, self._values)
+        ])
+        return f"<{result}>"
 
 
 class ResultConfig(NamedTuple):
     limit: Union[int, None] = None
     order_by: Union[str, None] = None
     reverse: bool = False
+    after: Union[str, None] = None
+    before: Union[str, None] = None
+
+
+class StaleRowError(Exception):
+    pass
 
 
 class DB:
@@ -137,73 +216,225 @@ class DB:
     table_name = GenerateTableName()
     columns = GetColumns()
     foreign_keys = GetForeignKeys()
-    _query = ''
+    indexes: List[Index] = []
+    search_fields: Tuple[str, ...] = ()
+    cache_results: bool = False
+    lazy_sync: bool = False
+    memory_replica: bool = False
+    pragmas: Dict[str, Any] = {}
+    _models: Dict[Tuple[str, str], type] = {}
+    _version_column: Union[str, None] = None
+    _references: Dict[str, str] = {}
+    _row_classes: Dict[Tuple[str, ...], type] = {}
+    _synced = True
+    _sync_lock = threading.RLock()
+    _syncing = threading.local()
 
     def __init__(self, **data):
+        data = self._prepare_data(data)
+        row_id = self.insert(**data)
         data = {
-            'id': self._get_max_id() + 1,
+            'id': data.get('id', row_id),
             **data,
         }
-        for key, value in data.items():
-            if key in self.foreign_keys.keys():
-                data[key] = value.id
         self.data = data
         for key, value in data.items():
             self.__setattr__(key, value)
         self.id = self.id  # just for type hinting
-        self.insert(**data)
 
     def __init_subclass__(cls, **kwargs):
-        cls._manage_table()
+        cls._references = {
+            key.lower(): value.reference
+            for key, value in cls.__dict__.items()
+            if isinstance(value, ForeignKey)
+        }
+        cls._version_column = next((
+            key.lower()
+            for key, value in cls.__dict__.items()
+            if isinstance(value, Version)
+        ), None)
+        if 'db_name' not in cls.__dict__:
+            # resolving the source file is slow, do it once per model
+            cls.db_name = DB.__dict__['db_name'].__get__(None, cls)
+        if 'pragmas' in cls.__dict__:
+            connections.configure_database(cls.db_name, cls.pragmas)
+        fields = tuple(cls.columns.keys())
+        row_class = Row.build(cls, fields)
+        cls._row_classes = {(): row_class, fields: row_class}
+        DB._models[(cls.db_name, cls.table_name)] = cls
+        cls._synced = False
+        if not cls.lazy_sync:
+            cls._ensure_table()
 
     @classmethod
     def insert(cls, **data: dict):
-        fields = ', '.join(data.keys())
-        values = ', '.join(
-            map(repr, data.values())
-        )
-        query = (f'INSERT OR IGNORE INTO {cls.table_name} '
-                 f'({fields}) VALUES ({values});')
-        cls._execute(query)
+        query = cls._insert_query(tuple(data.keys()))
+        cursor = cls._execute(query, tuple(data.values()))
+        if cursor.rowcount:
+            return cursor.lastrowid
+        return None
+
+    @classmethod
+    def enqueue(cls, **data) -> Future:
+        # write-behind insert, resolves to the new id once committed
+        data = cls._prepare_data(data)
+        query = cls._insert_query(tuple(data.keys()))
+        inserted: Future = Future()
+
+        def done(future: Future):
+            if future.exception() is not None:
+                inserted.set_exception(future.exception())
+                return
+            cursor = future.result()
+            inserted.set_result(cursor.lastrowid if cursor.rowcount else None)
+        cls._submit(query, tuple(data.values())).add_done_callback(done)
+        return inserted
+
+    @classmethod
+    def _insert_query(cls, fields: Tuple[str, ...]) -> str:
+        def build():
+            placeholders = ', '.join(['?'] * len(fields))
+            return (f'INSERT OR IGNORE INTO {cls.table_name} '
+                    f'({", ".join(fields)}) VALUES ({placeholders});')
+        return statements.get(('insert', cls.table_name, fields), build)
+
+    @classmethod
+    def bulk_create(cls, objects: Iterable[Union[dict, Row, DB]],
+                    batch_size: int = 500) -> List[int]:
+        cls._ensure_table()
+        ids = []
+        with cls.transaction(immediate=True), \
+                connections.connection(cls.db_name) as conn:
+            for batch in cls._batches(objects, batch_size):
+                ids.extend(cls._insert_batch(conn, batch))
+            if results.enabled:
+                results.touch(conn, cls.db_name, cls.table_name)
+        return ids
+
+    @classmethod
+    def _insert_batch(cls, conn: sqlite3.Connection,
+                      batch: List[dict]) -> List[int]:
+        ids = []
+        # rows sharing the same columns go through one executemany call
+        for fields, group in groupby(batch, key=lambda data: tuple(data)):
+            rows = [tuple(data.values()) for data in group]
+
+            def build():
+                placeholders = ', '.join(['?'] * len(fields))
+                return (f'INSERT INTO {cls.table_name} '
+                        f'({", ".join(fields)}) VALUES ({placeholders});')
+            query = statements.get(
+                ('bulk_insert', cls.table_name, fields), build,
+            )
+            started = time.perf_counter()
+            conn.executemany(query, rows)
+            cls._log_query(query, (), started, len(rows))
+            if 'id' in fields:
+                index = fields.index('id')
+                ids.extend(row[index] for row in rows)
+                continue
+            # the write lock is held for the whole transaction, so sqlite
+            # hands out consecutive rowids ending at last_insert_rowid()
+            last_id = conn.execute('SELECT last_insert_rowid();').fetchone()[0]
+            ids.extend(range(last_id - len(rows) + 1, last_id + 1))
+        return ids
+
+    @classmethod
+    def _batches(cls, objects: Iterable[Union[dict, Row, DB]],
+                 batch_size: int) -> Iterator[List[dict]]:
+        batch = []
+        for obj in objects:
+            data = obj if isinstance(obj, dict) else obj.data
+            batch.append(cls._prepare_data(data))
+            if len(batch) >= batch_size:
+                yield batch
+                batch = []
+        if batch:
+            yield batch
+
+    @classmethod
+    def _prepare_data(cls, data: dict) -> dict:
+        data = dict(data)
+        if data.get('id', 0) is None:
+            del data['id']
+        if cls._version_column is not None:
+            data.setdefault(cls._version_column, 0)
+        for key, value in data.items():
+            if key in cls.foreign_keys.keys():
+                data[key] = getattr(value, 'id', value)
+        return data
 
     @ classmethod
-    def all(cls, config: Union[ResultConfig, None] = None) -> List[Row]:
-        configs = cls._set_config(config)
-        query = f'SELECT * FROM {cls.table_name}{configs};'
-        return cls._fetchall(query)
+    def all(cls, config: Union[ResultConfig, None] = None) -> QuerySet:
+        return QuerySet(cls).configure(config)
 
     @ classmethod
     def get(cls, *fields: dict,
-            config: Union[ResultConfig, None] = None) -> List[Row]:
-        fields = [
+            config: Union[ResultConfig, None] = None) -> QuerySet:
+        fields = tuple(
             field
             for field in fields
             if field in cls.columns
-        ]
-        fields_string = ', '.join(fields) or '*'
-        configs = cls._set_config(config)
-        query = f'SELECT {fields_string} FROM {cls.table_name}{configs};'
-        return cls._fetchall(query)
+        )
+        return QuerySet(cls, fields).configure(config)
 
     @ classmethod
     def filter(cls, *args, config: Union[ResultConfig, None] = None,
-               **kwargs) -> List[Row]:
-        conditions = []
-        for key, value in kwargs.items():
-            if '__' in key:
-                condition = cls._set_operator_filter(key, value)
-            else:
-                condition = f'{key} = {repr(value)}'
-            if condition is not None:
-                conditions.append(condition)
-                condition = None
-        conditions.extend(list(map(repr, args)))
-        statements = ' AND '.join(conditions) or 'true'
-        configs = cls._set_config(config)
-        query = (
-            f'SELECT * FROM {cls.table_name} WHERE {statements}{configs};'
+               **kwargs) -> QuerySet:
+        return cls.all(config).filter(*args, **kwargs)
+
+    @classmethod
+    def search(cls, query: str, rank: bool = True,
+               raw: bool = False) -> QuerySet:
+        assert cls.search_fields, (
+            f'{cls.__name__} has no search_fields!'
+        )
+        if not query.split():
+            # fts5 rejects an empty MATCH, and nothing would match it anyway
+            return QuerySet(cls).filter('false')
+        if not raw:
+            # match every word as a prefix so user input can't break the
+            # fts5 query syntax
+            query = ' '.join(
+                '"{}"*'.format(word.replace('"', '""'))
+                for word in query.split()
+            )
+        table_name = cls.table_name
+        queryset = QuerySet(cls).join(
+            f'JOIN (SELECT rowid AS fts_rowid, rank AS fts_rank '
+            f'FROM {table_name}_fts WHERE {table_name}_fts MATCH ?) '
+            f'AS fts ON fts.fts_rowid = {table_name}.id',
+            query,
+        )
+        if rank:
+            queryset._order_by = (('fts.fts_rank', False),)
+        return queryset
+
+    @classmethod
+    async def aall(cls, config: Union[ResultConfig, None] = None
+                   ) -> QuerySet:
+        return await cls.all(config).afetch()
+
+    @classmethod
+    async def aget(cls, *fields: str,
+                   config: Union[ResultConfig, None] = None) -> QuerySet:
+        return await cls.get(*fields, config=config).afetch()
+
+    @classmethod
+    async def afilter(cls, *args, config: Union[ResultConfig, None] = None,
+                      **kwargs) -> QuerySet:
+        return await cls.filter(*args, config=config, **kwargs).afetch()
+
+    @classmethod
+    async def acreate(cls, **data) -> DB:
+        return await executor.write(partial(cls, **data))
+
+    @classmethod
+    async def abulk_create(cls, objects: Iterable[Union[dict, Row, DB]],
+                           batch_size: int = 500) -> List[int]:
+        return await executor.write(
+            cls.bulk_create, list(objects), batch_size,
         )
-        return cls._fetchall(query)
 
     @ classmethod
     def max(cls, column_name: str):
@@ -242,69 +473,404 @@ class DB:
 
     @classmethod
     def first(cls) -> DB:
-        query = f'SELECT * FROM {cls.table_name} WHERE id=1;'
-        result = cls._fetch_result(query)
+        columns = ', '.join(cls.columns)
+        query = f'SELECT {columns} FROM {cls.table_name} WHERE id = ?;'
+        result = cls._fetch_result(query, (1,))
         if result is None:
             return None
-        row = dict(zip(cls.columns.keys(), result))
-        return Row(cls.db_name, cls.table_name, **row)
+        return cls._row_class()(result)
 
     @classmethod
     def last(cls) -> DB:
         max_id = cls._get_max_id()
-        query = f'SELECT * FROM {cls.table_name} WHERE id={max_id};'
-        result = cls._fetch_result(query)
+        columns = ', '.join(cls.columns)
+        query = f'SELECT {columns} FROM {cls.table_name} WHERE id = ?;'
+        result = cls._fetch_result(query, (max_id,))
         if result is None:
             return None
-        row = dict(zip(cls.columns.keys(), result))
-        return Row(cls.db_name, cls.table_name, **row)
+        return cls._row_class()(result)
 
     def remove(self):
-        where = ' AND '.join([
-            f'{key} = {repr(value)}'
-            for key, value in self.data.items()
-        ])
-        query = f'DELETE FROM {self.table_name} WHERE {where};'
-        self._execute(query)
+        self._remove_row(self.data)
 
     def update(self, **kwargs):
-        where = ' AND '.join([
-            f'{key} = {repr(value)}'
-            for key, value in self.data.items()
-        ])
-        new_data = ', '.join([
-            f'{key} = {repr(value)}'
-            for key, value in kwargs.items()
-        ])
-        if new_data.strip():
-            query = (
-                f'UPDATE {self.table_name} SET {new_data} WHERE {where};'
-            )
-            self._execute(query)
-        query = f'SELECT * FROM {self.table_name} WHERE id={self.id};'
-        result = self._fetch_result(query)
-        data = dict(zip(self.columns.keys(), result))
-        self.data = data
+        data = self._update_row(self.data, kwargs)
+        self.data.update(data)
         self.__dict__.update(data)
 
+    async def aremove(self):
+        await executor.write(self.remove)
+
+    async def aupdate(self, **kwargs):
+        await executor.write(partial(self.update, **kwargs))
+
+    @classmethod
+    @contextmanager
+    def open_blob(cls, field: str, row_id: int,
+                  readonly: bool = True) -> Iterator[Any]:
+        field = cls._check_blob_field(field)
+        if not hasattr(sqlite3.Connection, 'blobopen'):
+            raise NotImplementedError(
+                'Incremental blob I/O needs Python 3.11 or newer.'
+            )
+        cls._ensure_table()
+        with connections.connection(cls.db_name) as conn:
+            with conn.blobopen(
+                    cls.table_name, field, row_id, readonly=readonly) as blob:
+                yield blob
+
+    @classmethod
+    def blob_size(cls, field: str, row_id: int) -> Union[int, None]:
+        field = cls._check_blob_field(field)
+        result = cls._fetch_result(
+            f'SELECT length({field}) FROM {cls.table_name} WHERE id = ?;',
+            (row_id,),
+        )
+        return result and result[0]
+
+    @classmethod
+    def read_blob(cls, field: str, row_id: int, start: int = 0,
+                  stop: Union[int, None] = None,
+                  chunk_size: int = 64 * 1024) -> Iterator[bytes]:
+        if not hasattr(sqlite3.Connection, 'blobopen'):
+            yield from cls._read_blob_chunks(
+                field, row_id, start, stop, chunk_size,
+            )
+            return
+        # the connection stays checked out until the stream is exhausted
+        # or closed
+        with cls.open_blob(field, row_id) as blob:
+            stop = len(blob) if stop is None else min(stop, len(blob))
+            blob.seek(start)
+            position = start
+            while position < stop:
+                chunk = blob.read(min(chunk_size, stop - position))
+                if not chunk:
+                    break
+                position += len(chunk)
+                yield chunk
+
+    @classmethod
+    def write_blob(cls, field: str, row_id: int,
+                   data: Union[bytes, BinaryIO],
+                   size: Union[int, None] = None,
+                   chunk_size: int = 64 * 1024) -> int:
+        field = cls._check_blob_field(field)
+        if isinstance(data, (bytes, bytearray, memoryview)):
+            size = len(data)
+            data = io.BytesIO(data)
+        elif size is None:
+            raise ValueError('`size` is required to write from a stream.')
+        values = [f'{field} = zeroblob(?)']
+        if cls._version_column is not None:
+            version = cls._version_column
+            values.append(f'{version} = {version} + 1')
+        query = (
+            f'UPDATE {cls.table_name} SET {", ".join(values)} WHERE id = ?;'
+        )
+        with connections.transaction(immediate=True):
+            if not hasattr(sqlite3.Connection, 'blobopen'):
+                query = query.replace('zeroblob(?)', '?')
+                cursor = cls._execute(query, (data.read(size), row_id))
+            else:
+                cursor = cls._execute(query, (size, row_id))
+            if not cursor.rowcount:
+                raise ValueError(
+                    f'{cls.table_name} row {row_id} does not exist!'
+                )
+            if hasattr(sqlite3.Connection, 'blobopen'):
+                # space is reserved up front, then filled chunk by chunk
+                with cls.open_blob(field, row_id, readonly=False) as blob:
+                    written = 0
+                    while written < size:
+                        chunk = data.read(min(chunk_size, size - written))
+                        if not chunk:
+                            raise ValueError(
+                                f'The stream ended after {written} of '
+                                f'{size} bytes.'
+                            )
+                        blob.write(chunk)
+                        written += len(chunk)
+        return size
+
+    @classmethod
+    def _read_blob_chunks(cls, field: str, row_id: int, start: int,
+                          stop: Union[int, None],
+                          chunk_size: int) -> Iterator[bytes]:
+        field = cls._check_blob_field(field)
+        size = cls.blob_size(field, row_id) or 0
+        stop = size if stop is None else min(stop, size)
+        query = (
+            f'SELECT substr({field}, ?, ?) FROM {cls.table_name} '
+            'WHERE id = ?;'
+        )
+        for position in range(start, stop, chunk_size):
+            length = min(chunk_size, stop - position)
+            yield cls._fetch_result(query, (position + 1, length, row_id))[0]
+
+    @classmethod
+    def _check_blob_field(cls, field: str) -> str:
+        field = field.lower()
+        definition = cls.columns.get(field)
+        if definition is None or definition.split()[1] != 'BLOB':
+            raise ValueError(
+                f'`{field}` is not a blob column of {cls.__name__}!'
+            )
+        return field
+
+    @ staticmethod
+    def transaction(immediate: bool = False):
+        return connections.transaction(immediate)
+
     @ classmethod
     def remove_table(cls):
         query = f'DROP TABLE {cls.table_name}'
         cls._execute(query)
+        if cls.search_fields:
+            cls._execute(f'DROP TABLE IF EXISTS {cls.table_name}_fts;')
+        cls._execute(
+            f'DELETE FROM {SCHEMA_TABLE} WHERE name = ?;', (cls.table_name,),
+        )
+        cls._synced = False
 
     @ classmethod
     def queries(cls):
-        return cls._query.strip()
+        return '\n\n'.join(
+            entry.format() for entry in query_log.entries(cls)
+        )
+
+    @classmethod
+    def _ensure_table(cls):
+        if cls._synced:
+            return
+        with cls._sync_lock:
+            syncing = vars(cls._syncing).setdefault('models', set())
+            # schema sync runs its own queries through the same entry
+            # points, other threads keep waiting on the lock until it's done
+            if cls._synced or cls in syncing:
+                return
+            syncing.add(cls)
+            try:
+                cls._manage_table()
+                cls._synced = True
+            finally:
+                syncing.discard(cls)
 
     @ classmethod
     def _manage_table(cls) -> str:
-        try:
-            current_columns = cls._get_current_table_columns()
+        indexes = cls._declared_indexes()
+        fingerprint = cls._schema_fingerprint(indexes)
+        if cls._stored_fingerprint() == fingerprint:
+            return
+        current_columns = cls._get_current_table_columns()
+        if current_columns:
+            cls._drop_indexes(indexes)
             if current_columns != list(cls.columns.keys()):
                 cls._alter_columns(current_columns)
                 cls._drop_columns(current_columns)
-        except sqlite3.OperationalError:
+        else:
             cls._create_table()
+        cls._create_indexes(indexes)
+        cls._sync_search_table()
+        cls._sync_version_triggers()
+        cls._execute(
+            f'CREATE TABLE IF NOT EXISTS {SCHEMA_TABLE} '
+            '(name TEXT PRIMARY KEY, fingerprint TEXT NOT NULL);'
+        )
+        cls._execute(
+            f'INSERT INTO {SCHEMA_TABLE} (name, fingerprint) VALUES (?, ?) '
+            'ON CONFLICT (name) DO UPDATE '
+            'SET fingerprint = excluded.fingerprint;',
+            (cls.table_name, fingerprint),
+        )
+
+    @classmethod
+    def _schema_fingerprint(cls, indexes: Dict[str, str]) -> str:
+        schema = repr((
+            cls.table_name,
+            list(cls.columns.values()),
+            list(cls.foreign_keys.values()),
+            sorted(indexes.values()),
+            sorted(cls._search_schema().values()),
+            cls._replica_triggers(),
+        ))
+        return sha256(schema.encode()).hexdigest()
+
+    @classmethod
+    def _stored_fingerprint(cls) -> Union[str, None]:
+        query = f'SELECT fingerprint FROM {SCHEMA_TABLE} WHERE name = ?;'
+        try:
+            result = cls._fetch_result(
+                query, (cls.table_name,), replica=False,
+            )
+        except sqlite3.OperationalError:
+            return None
+        return result and result[0]
+
+    @classmethod
+    def _declared_indexes(cls) -> Dict[str, str]:
+        indexes = [
+            Index(key)
+            for key, value in cls.__dict__.items()
+            # unique columns are already backed by sqlite's own index
+            if isinstance(value, Column) and value.index and not value.unique
+        ]
+        indexes.extend(cls.indexes)
+        return {
+            index.get_name(cls.table_name): index.get_statement(
+                cls.table_name
+            )
+            for index in indexes
+        }
+
+    @classmethod
+    def _search_schema(cls) -> Dict[str, str]:
+        table_name = cls.table_name
+        search_table = f'{table_name}_fts'
+        fields = [field.lower() for field in cls.search_fields]
+        if not fields:
+            return {}
+        new = ', '.join(f'new.{field}' for field in fields)
+        old = ', '.join(f'old.{field}' for field in fields)
+        columns = ', '.join(fields)
+        delete = (
+            f'INSERT INTO {search_table}({search_table}, rowid, {columns}) '
+            f"VALUES ('delete', old.id, {old});"
+        )
+        insert = (
+            f'INSERT INTO {search_table}(rowid, {columns}) '
+            f'VALUES (new.id, {new});'
+        )
+        return {
+            search_table: (
+                f'CREATE VIRTUAL TABLE {search_table} USING fts5('
+                f"{columns}, content='{table_name}', content_rowid='id')"
+            ),
+            f'{search_table}_ai': (
+                f'CREATE TRIGGER {search_table}_ai AFTER INSERT ON '
+                f'{table_name} BEGIN {insert} END'
+            ),
+            f'{search_table}_ad': (
+                f'CREATE TRIGGER {search_table}_ad AFTER DELETE ON '
+                f'{table_name} BEGIN {delete} END'
+            ),
+            # only writes to indexed columns have to touch the index
+            f'{search_table}_au': (
+                f'CREATE TRIGGER {search_table}_au AFTER UPDATE OF '
+                f'{columns} ON {table_name} BEGIN {delete} {insert} END'
+            ),
+        }
+
+    @classmethod
+    def _sync_search_table(cls):
+        search_table = f'{cls.table_name}_fts'
+        triggers = [f'{search_table}_{trigger}' for trigger in
+                    ('ai', 'ad', 'au')]
+        schema = cls._search_schema()
+        with connections.connection(cls.db_name) as conn:
+            current = dict(conn.execute(
+                'SELECT name, sql FROM sqlite_master '
+                'WHERE name IN (?, ?, ?, ?) AND sql IS NOT NULL;',
+                (search_table, *triggers),
+            ).fetchall())
+        if current == schema:
+            return
+        rebuild = current.get(search_table) != schema.get(search_table)
+        for trigger in triggers:
+            cls._execute(f'DROP TRIGGER IF EXISTS {trigger};')
+        if rebuild:
+            cls._execute(f'DROP TABLE IF EXISTS {search_table};')
+        for name, statement in schema.items():
+            if name != search_table or rebuild:
+                cls._execute(f'{statement};')
+        if schema and rebuild:
+            cls._execute(
+                f"INSERT INTO {search_table}({search_table}) "
+                "VALUES ('rebuild');"
+            )
+
+    @classmethod
+    def _replica_triggers(cls) -> List[str]:
+        # replicas only refresh when their table's version moved, and
+        # copy just the rows logged since, triggers do both for every
+        # writer, including raw sql from other tools
+        if not cls.memory_replica:
+            return []
+        table_name = cls.table_name
+        bump = (
+            f'INSERT INTO {VERSIONS_TABLE} (name, version) '
+            f"VALUES ('{table_name}', 1) "
+            'ON CONFLICT (name) DO UPDATE SET version = version + 1;'
+        )
+        prune = (
+            f'DELETE FROM {CHANGES_TABLE} WHERE seq <= '
+            f'(SELECT MAX(seq) FROM {CHANGES_TABLE}) - {KEPT_CHANGES};'
+        )
+        triggers = []
+        for trigger, event, old, new in (
+                ('ai', 'INSERT', 'NULL', 'new.id'),
+                ('ad', 'DELETE', 'old.id', 'NULL'),
+                ('au', 'UPDATE', 'old.id', 'new.id')):
+            log = (
+                f'INSERT INTO {CHANGES_TABLE} (name, old_id, new_id) '
+                f"VALUES ('{table_name}', {old}, {new});"
+            )
+            triggers.append(
+                f'CREATE TRIGGER {table_name}_version_{trigger} '
+                f'AFTER {event} ON {table_name} '
+                f'BEGIN {bump} {log} {prune} END;'
+            )
+        return triggers
+
+    @classmethod
+    def _sync_version_triggers(cls):
+        table_name = cls.table_name
+        for trigger in ('ai', 'ad', 'au'):
+            cls._execute(
+                f'DROP TRIGGER IF EXISTS {table_name}_version_{trigger};'
+            )
+        triggers = cls._replica_triggers()
+        if not triggers:
+            return
+        cls._execute(
+            f'CREATE TABLE IF NOT EXISTS {VERSIONS_TABLE} '
+            '(name TEXT PRIMARY KEY, version INTEGER NOT NULL);'
+        )
+        cls._execute(
+            f'CREATE TABLE IF NOT EXISTS {CHANGES_TABLE} '
+            '(seq INTEGER PRIMARY KEY AUTOINCREMENT, name TEXT NOT NULL, '
+            'old_id INTEGER, new_id INTEGER);'
+        )
+        for trigger in triggers:
+            cls._execute(trigger)
+
+    @classmethod
+    def _current_indexes(cls) -> Dict[str, str]:
+        query = (
+            "SELECT name, sql FROM sqlite_master "
+            "WHERE type = 'index' AND tbl_name = ?;"
+        )
+        with connections.connection(cls.db_name) as conn:
+            rows = conn.execute(query, (cls.table_name,)).fetchall()
+        prefixes = (f'ix_{cls.table_name}_', f'ux_{cls.table_name}_')
+        return {
+            name: sql
+            for name, sql in rows
+            if name.startswith(prefixes)
+        }
+
+    @classmethod
+    def _drop_indexes(cls, indexes: Dict[str, str]):
+        for name, sql in cls._current_indexes().items():
+            if indexes.get(name) != sql:
+                cls._execute(f'DROP INDEX IF EXISTS {name};')
+
+    @classmethod
+    def _create_indexes(cls, indexes: Dict[str, str]):
+        current_indexes = cls._current_indexes()
+        for name, sql in indexes.items():
+            if name not in current_indexes:
+                cls._execute(f'{sql};')
 
     @ classmethod
     def _create_table(cls) -> str:
@@ -339,44 +905,82 @@ class DB:
             query = f'ALTER TABLE {cls.table_name} DROP {field};'
             cls._execute(query)
 
-    @ staticmethod
-    def _set_config(config: Union[ResultConfig, None]) -> str:
-        if config is None:
-            return ''
-        limit, order_by, reverse = config
-        if limit is None:
-            limit = ''
-        else:
-            limit = f' LIMIT {limit}'
-        if order_by is None:
-            order_by = ''
-            sorting = ''
-        else:
-            order_by = F'ORDER BY {order_by}'
-            if reverse is False:
-                sorting = ' ASC'
-            else:
-                sorting = ' DESC'
-        return f' {order_by}{sorting}{limit}'
+    @classmethod
+    def _remove_row(cls, data: dict):
+        fields = cls._row_lookup_fields(data)
 
-    @ staticmethod
-    def _set_operator_filter(key: str, value: str):
-        filter = key.split('__')
-        if len(filter) != 2:
-            return None
-        key, operator = filter
-        key, operator = key.lower(), operator.lower()
-        if operator in OPERATORS:
-            return (
-                f'{key} {OPERATORS[operator]} {repr(value)}'
+        def build():
+            where = cls._row_where(fields)
+            return f'DELETE FROM {cls.table_name} WHERE {where};'
+        query = statements.get(('remove', cls.table_name, fields), build)
+        cursor = cls._execute(query, tuple(data[key] for key in fields))
+        if cls._version_column in fields and not cursor.rowcount:
+            raise StaleRowError(
+                f'{cls.table_name} row {data.get("id")} was changed or '
+                'removed by another writer.'
             )
-        elif operator == 'between':
-            start, *_, end = value
+
+    @classmethod
+    def _update_row(cls, data: dict, new_data: dict) -> dict:
+        new_data = {
+            key: getattr(value, 'id', value)
+            if key in cls.foreign_keys.keys() else value
+            for key, value in new_data.items()
+        }
+        if not new_data:
+            return new_data
+        fields = cls._row_lookup_fields(data)
+        new_fields = tuple(new_data.keys())
+        versioned = cls._version_column in fields
+
+        def build():
+            where = cls._row_where(fields)
+            values = [f'{key} = ?' for key in new_fields]
+            if versioned:
+                version = cls._version_column
+                values.append(f'{version} = {version} + 1')
             return (
-                f'{key} BETWEEN {repr(start)} AND {repr(end)}'
+                f'UPDATE {cls.table_name} SET {", ".join(values)} '
+                f'WHERE {where};'
             )
-        else:
-            return None
+        query = statements.get(
+            ('update', cls.table_name, fields, new_fields), build,
+        )
+        params = (*new_data.values(), *(data[key] for key in fields))
+        cursor = cls._execute(query, params)
+        if versioned:
+            if not cursor.rowcount:
+                raise StaleRowError(
+                    f'{cls.table_name} row {data.get("id")} was changed or '
+                    'removed by another writer.'
+                )
+            new_data[cls._version_column] = data[cls._version_column] + 1
+        return new_data
+
+    @classmethod
+    def _row_where(cls, fields: Tuple[str, ...]) -> str:
+        if fields[0] == 'id':
+            return ' AND '.join([f'{key} = ?' for key in fields])
+        return ' AND '.join([f'{key} IS ?' for key in fields])
+
+    @classmethod
+    def _row_lookup_fields(cls, data: dict) -> Tuple[str, ...]:
+        # rows are addressed by primary key, rows selected without an id
+        # fall back to matching every loaded column.
+        if data.get('id') is None:
+            return tuple(data.keys())
+        if data.get(cls._version_column) is not None:
+            return ('id', cls._version_column)
+        return ('id',)
+
+    @classmethod
+    def _load_deferred(cls, field: str, row_id: int) -> Any:
+        query = statements.get(
+            ('deferred', cls.table_name, field),
+            lambda: f'SELECT {field} FROM {cls.table_name} WHERE id = ?;',
+        )
+        result = cls._fetch_result(query, (row_id,))
+        return result and result[0]
 
     @ classmethod
     def _get_max_id(cls):
@@ -385,51 +989,203 @@ class DB:
         return result[0] or 0
 
     @ classmethod
-    def _execute(cls, query: str):
-        cls._query += f"{query}\n\n"
-        conn = sqlite3.connect(cls.db_name)
-        conn.execute(query)
-        conn.commit()
-        conn.close()
+    def _execute(cls, query: str, params: tuple = ()) -> sqlite3.Cursor:
+        cls._ensure_table()
+        started = time.perf_counter()
+        if writer.active() and not connections.in_transaction():
+            cursor = cls._submit(query, params).result()
+        elif not results.enabled:
+            with connections.connection(cls.db_name) as conn:
+                cursor = conn.execute(query, params)
+        else:
+            # the version bump commits together with the write itself
+            with connections.transaction(), \
+                    connections.connection(cls.db_name) as conn:
+                cursor = conn.execute(query, params)
+                results.touch(conn, cls.db_name, cls.table_name)
+        cls._log_query(query, params, started, max(cursor.rowcount, 0))
+        return cursor
+
+    @classmethod
+    def _submit(cls, query: str, params: tuple = ()) -> Future:
+        cls._ensure_table()
+
+        def write(conn: sqlite3.Connection) -> sqlite3.Cursor:
+            cursor = conn.execute(query, params)
+            if results.enabled:
+                results.touch(conn, cls.db_name, cls.table_name)
+            return cursor
+        return writer.submit(cls.db_name, write)
 
     @ classmethod
-    def _fetchall(cls, query: str) -> Rows:
-        cls._query += f"{query}\n\n"
-        conn = sqlite3.connect(cls.db_name)
-        cur = conn.cursor()
-        cur.execute(query)
-        rows = cur.fetchall()
-        result = []
-        for row in rows:
-            row = dict(zip(
-                cls.columns.keys(),
-                row
-            ))
-            result.append(
-                Row(cls.db_name, cls.table_name, **row)
+    def _fetchall(cls, query: str, params: tuple = (),
+                  fields: Tuple[str, ...] = (),
+                  related: Tuple[Tuple[str, type], ...] = (),
+                  tables: Tuple[str, ...] = ()) -> List[Row]:
+        cls._ensure_table()
+        hit, rows, token = cls._cache_lookup(query, params, tables)
+        if not hit:
+            started = time.perf_counter()
+            rows = cls._read(
+                query, params, sqlite3.Cursor.fetchall, not related,
             )
-        conn.close()
-        return Rows(result)
+            cls._log_query(query, params, started, len(rows))
+            results.store(token, rows)
+        return list(cls._build_rows(rows, fields, related))
+
+    @classmethod
+    def _read(cls, query: str, params: tuple, fetch: Callable,
+              replica: bool = True) -> Any:
+        # reads inside a transaction must see its uncommitted writes, and
+        # joined tables aren't copied into the replica
+        if (replica and cls.memory_replica and
+                not connections.in_transaction()):
+            try:
+                with replicas.replica(
+                        cls.db_name, cls.table_name).connection() as conn:
+                    return fetch(conn.execute(query, params))
+            except sqlite3.OperationalError:
+                # e.g. a search joining the fts table
+                pass
+        with connections.connection(cls.db_name) as conn:
+            return fetch(conn.execute(query, params))
+
+    @classmethod
+    def _cache_lookup(cls, query: str, params: tuple,
+                      tables: Tuple[str, ...]) -> Tuple[bool, Any, Any]:
+        if not tables or not results.enabled:
+            return False, None, None
+        return results.lookup(
+            cls.db_name, query, params, tables,
+            connections.in_transaction(),
+        )
+
+    @classmethod
+    def _build_rows(cls, rows: List[tuple], fields: Tuple[str, ...],
+                    related: Tuple[Tuple[str, type], ...]) -> Iterator[Row]:
+        row_class = cls._row_class(fields)
+        if not related:
+            return map(row_class, rows)
+        return (
+            cls._build_related_row(row_class, row, related)
+            for row in rows
+        )
+
+    @staticmethod
+    def _build_related_row(row_class: type, values: tuple,
+                           related: Tuple[Tuple[str, type], ...]) -> Row:
+        # joined columns follow the row's own columns, one block per
+        # relation in select_related order
+        start = len(row_class._fields)
+        row = row_class(values[:start])
+        for name, model in related:
+            related_class = model._row_class()
+            end = start + len(related_class._fields)
+            block = values[start:end]
+            row._set_related(
+                name, None if block[0] is None else related_class(block),
+            )
+            start = end
+        return row
+
+    @classmethod
+    def _related_model(cls, name: str) -> type:
+        reference = cls._references.get(name)
+        if reference is None:
+            raise ValueError(
+                f'`{name}` is not a foreign key of {cls.__name__}!'
+            )
+        return DB._models[(cls.db_name, reference)]
+
+    @classmethod
+    def _row_class(cls, fields: Tuple[str, ...] = ()) -> type:
+        row_class = cls._row_classes.get(fields)
+        if row_class is None:
+            row_class = Row.build(cls, fields)
+            cls._row_classes[fields] = row_class
+        return row_class
 
     @ classmethod
-    def _fetch_result(cls, query: str):
-        cls._query += f"{query}\n\n"
-        conn = sqlite3.connect(cls.db_name)
-        cur = conn.cursor()
-        cur.execute(query)
-        result = cur.fetchone()
-        conn.close()
+    def _fetchmany(cls, query: str, params: tuple = (),
+                   fields: Tuple[str, ...] = (),
+                   chunk_size: int = 500,
+                   related: Tuple[Tuple[str, type], ...] = ()
+                   ) -> Iterator[Row]:
+        cls._ensure_table()
+        started = time.perf_counter()
+        count = 0
+        with connections.connection(cls.db_name) as conn:
+            cursor = conn.execute(query, params)
+            try:
+                rows = cursor.fetchmany(chunk_size)
+                while rows:
+                    count += len(rows)
+                    yield from cls._build_rows(rows, fields, related)
+                    rows = cursor.fetchmany(chunk_size)
+            finally:
+                cursor.close()
+                # the duration covers the whole stream, consumer included
+                cls._log_query(query, params, started, count)
+
+    @classmethod
+    def _fetch_columns(cls, query: str, params: tuple,
+                       typecodes: List[Union[str, None]],
+                       chunk_size: int) -> List[Union[array, list]]:
+        cls._ensure_table()
+        columns: List[Union[array, list]] = [
+            array(typecode) if typecode else [] for typecode in typecodes
+        ]
+        started = time.perf_counter()
+        count = 0
+        with connections.connection(cls.db_name) as conn:
+            cursor = conn.execute(query, params)
+            try:
+                rows = cursor.fetchmany(chunk_size)
+                while rows:
+                    count += len(rows)
+                    for index, values in enumerate(zip(*rows)):
+                        column = columns[index]
+                        size = len(column)
+                        try:
+                            column.extend(values)
+                        except TypeError:
+                            # NULLs (or stray text) don't fit a typed array
+                            column = columns[index] = column[:size].tolist()
+                            column.extend(values)
+                    rows = cursor.fetchmany(chunk_size)
+            finally:
+                cursor.close()
+        cls._log_query(query, params, started, count)
+        return columns
+
+    @ classmethod
+    def _fetch_result(cls, query: str, params: tuple = (),
+                      tables: Tuple[str, ...] = (), replica: bool = True):
+        cls._ensure_table()
+        hit, result, token = cls._cache_lookup(query, params, tables)
+        if hit:
+            return result
+        started = time.perf_counter()
+        result = cls._read(query, params, sqlite3.Cursor.fetchone, replica)
+        cls._log_query(query, params, started, int(result is not None))
+        results.store(token, result)
         return result
 
+    @ classmethod
+    def _log_query(cls, query: str, params: tuple, started: float,
+                   rows: int):
+        query_log.record(
+            cls, query, params,
+            time.perf_counter() - started, rows,
+        )
+        if advisor.enabled:
+            advisor.observe(cls, query, params)
+
     @classmethod
     def _get_current_table_columns(cls):
-        query = f'SELECT * FROM {cls.table_name}'
-        conn = sqlite3.connect(cls.db_name)
-        cur = conn.cursor()
-        cur.execute(query)
-        columns = [description[0] for description in cur.description]
-        conn.close()
-        return columns
+        query = f'PRAGMA table_info({cls.table_name});'
+        with connections.connection(cls.db_name) as conn:
+            return [row[1] for row in conn.execute(query)]
 
     def __repr__(self) -> str:
         result = ', '.join([
@@ -0,0 +1,78 @@
+from __future__ import annotations
+from typing import Any, List, Set, Tuple
+
+
+def compile_value(value: Any) -> Tuple[str, List[Any]]:
+    if isinstance(value, Expression):
+        return value.compile()
+    return '?', [value]
+
+
+class Expression:
+    def compile(self) -> Tuple[str, List[Any]]:
+        raise NotImplementedError
+
+    def references(self) -> Set[str]:
+        raise NotImplementedError
+
+    def __add__(self, other: Any) -> Combined:
+        return Combined(self, '+', other)
+
+    def __radd__(self, other: Any) -> Combined:
+        return Combined(other, '+', self)
+
+    def __sub__(self, other: Any) -> Combined:
+        return Combined(self, '-', other)
+
+    def __rsub__(self, other: Any) -> Combined:
+        return Combined(other, '-', self)
+
+    def __mul__(self, other: Any) -> Combined:
+        return Combined(self, '*', other)
+
+    def __rmul__(self, other: Any) -> Combined:
+        return Combined(other, '*', self)
+
+    def __truediv__(self, other: Any) -> Combined:
+        return Combined(self, '/', other)
+
+    def __rtruediv__(self, other: Any) -> Combined:
+        return Combined(other, '/', self)
+
+    def __mod__(self, other: Any) -> Combined:
+        return Combined(self, '%', other)
+
+    def __repr__(self) -> str:
+        statement, params = self.compile()
+        return f'{statement} {tuple(params)}'
+
+
+class F(Expression):
+    def __init__(self, name: str) -> None:
+        self.name = name.lower()
+
+    def compile(self) -> Tuple[str, List[Any]]:
+        return self.name, []
+
+    def references(self) -> Set[str]:
+        return {self.name}
+
+
+class Combined(Expression):
+    def __init__(self, lhs: Any, operator: str, rhs: Any) -> None:
+        self.lhs = lhs
+        self.operator = operator
+        self.rhs = rhs
+
+    def compile(self) -> Tuple[str, List[Any]]:
+        lhs, lhs_params = compile_value(self.lhs)
+        rhs, rhs_params = compile_value(self.rhs)
+        return f'({lhs} {self.operator} {rhs})', [*lhs_params, *rhs_params]
+
+    def references(self) -> Set[str]:
+        return {
+            name
+            for side in (self.lhs, self.rhs)
+            if isinstance(side, Expression)
+            for name in side.references()
+        }
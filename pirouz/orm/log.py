@@ -0,0 +1,147 @@
+from __future__ import annotations
+import logging
+import os
+import sys
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from typing import Any, Deque, Iterator, List, NamedTuple, Union
+
+logger = logging.getLogger('pirouz.orm')
+
+ORM_DIR = os.path.dirname(os.path.abspath(__file__))
+MAX_PARAM_LENGTH = 100
+
+
+class QueryEntry(NamedTuple):
+    model: type
+    table: str
+    sql: str
+    params: tuple
+    duration: float
+    rows: int
+    caller: str
+    timestamp: float
+
+    def format(self) -> str:
+        if self.params:
+            return f'{self.sql} -- {self.params!r}'
+        return self.sql
+
+
+class QueryCounter:
+    def __init__(self) -> None:
+        self.count = 0
+        self.duration = 0.0
+        self.slow = 0
+
+
+class QueryLog:
+    def __init__(self, max_entries: int = 1000,
+                 slow_threshold: Union[float, None] = None,
+                 max_slow_entries: int = 100) -> None:
+        self.slow_threshold = slow_threshold
+        self.capture_callers = True
+        self._entries: Deque[QueryEntry] = deque(maxlen=max_entries)
+        self._slow: Deque[QueryEntry] = deque(maxlen=max_slow_entries)
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    def configure(self, max_entries: Union[int, None] = None,
+                  slow_threshold: Union[float, None, bool] = False,
+                  max_slow_entries: Union[int, None] = None,
+                  capture_callers: Union[bool, None] = None) -> None:
+        # `slow_threshold=None` turns the slow-query log off, so `False`
+        # means unchanged
+        if slow_threshold is not False:
+            self.slow_threshold = slow_threshold
+        if capture_callers is not None:
+            self.capture_callers = capture_callers
+        with self._lock:
+            if max_entries is not None:
+                self._entries = deque(self._entries, maxlen=max_entries)
+            if max_slow_entries is not None:
+                self._slow = deque(self._slow, maxlen=max_slow_entries)
+
+    def record(self, model: type, sql: str, params: tuple,
+               duration: float, rows: int) -> QueryEntry:
+        caller = self._caller() if self.capture_callers else ''
+        entry = QueryEntry(
+            model, model.table_name, sql, self._summarize(params), duration,
+            rows, caller,
+            time.time(),
+        )
+        slow = (self.slow_threshold is not None and
+                duration >= self.slow_threshold)
+        with self._lock:
+            self._entries.append(entry)
+            if slow:
+                self._slow.append(entry)
+        for counter in self._counters():
+            counter.count += 1
+            counter.duration += duration
+            counter.slow += slow
+        if slow:
+            logger.warning(
+                'Slow query (%.1fms, %d rows) from %s: %s',
+                duration * 1000, rows, caller or 'unknown', entry.format(),
+            )
+        return entry
+
+    def entries(self, model: Union[type, None] = None) -> List[QueryEntry]:
+        with self._lock:
+            entries = list(self._entries)
+        if model is None:
+            return entries
+        return [entry for entry in entries if entry.model is model]
+
+    def slow(self) -> List[QueryEntry]:
+        with self._lock:
+            return list(self._slow)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+            self._slow.clear()
+
+    @contextmanager
+    def track(self) -> Iterator[QueryCounter]:
+        counter = QueryCounter()
+        counters = self._counters()
+        counters.append(counter)
+        try:
+            yield counter
+        finally:
+            counters.remove(counter)
+
+    def _counters(self) -> List[QueryCounter]:
+        counters = getattr(self._local, 'counters', None)
+        if counters is None:
+            counters = self._local.counters = []
+        return counters
+
+    @staticmethod
+    def _summarize(params: tuple) -> tuple:
+        # large Blob and Text values would stay alive as long as the log
+        # keeps the entry, so only their size is recorded
+        return tuple(
+            f'<{type(value).__name__} of length {len(value)}>'
+            if isinstance(value, (str, bytes, bytearray, memoryview)) and
+            len(value) > MAX_PARAM_LENGTH else value
+            for value in params
+        )
+
+    @staticmethod
+    def _caller() -> str:
+        frame: Any = sys._getframe(2)
+        while frame is not None:
+            filename = frame.f_code.co_filename
+            if not filename.startswith(ORM_DIR):
+                return (f'{filename}:{frame.f_lineno} '
+                        f'in {frame.f_code.co_name}')
+            frame = frame.f_back
+        return ''
+
+
+query_log = QueryLog()
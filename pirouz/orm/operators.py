@@ -1,69 +1,180 @@
+from __future__ import annotations
+from functools import lru_cache
+from typing import Any, Iterator, List, Tuple, Union
+
 OPERATORS = {
+    'exact': '=',
     'lt': '<',
     'lte': '<=',
     'gt': '>',
     'gte': '>=',
     'n': '!=',
-    'in': 'IN',
     'like': 'LIKE',
 }
+LOOKUPS = (*OPERATORS, 'in', 'between', 'isnull', 'startswith')
+
+
+def prefix_bound(prefix: str) -> Union[str, None]:
+    # the smallest string greater than every string starting with prefix
+    while prefix:
+        last = ord(prefix[-1])
+        if last == 0xD7FF:
+            # surrogates can't be encoded, the next character is U+E000
+            return prefix[:-1] + '\ue000'
+        if last < 0x10FFFF:
+            return prefix[:-1] + chr(last + 1)
+        prefix = prefix[:-1]
+    return None
+
+
+def parse_lookup(key: str, value: Any) -> Tuple[tuple, list]:
+    if '__' not in key:
+        return (key.lower(), '=', 1), [value]
+    filter = key.split('__')
+    if len(filter) != 2 or filter[1].lower() not in LOOKUPS:
+        raise ValueError(f'Invalid lookup `{key}`!')
+    key, operator = filter
+    key, operator = key.lower(), operator.lower()
+    if operator == 'in':
+        values = list(value)
+        return (key, 'IN', len(values)), values
+    elif operator in OPERATORS:
+        return (key, OPERATORS[operator], 1), [value]
+    elif operator == 'between':
+        start, *_, end = value
+        return (key, 'BETWEEN', 2), [start, end]
+    elif operator == 'isnull':
+        if value:
+            return (key, 'IS NULL', 0), []
+        return (key, 'IS NOT NULL', 0), []
+    if not isinstance(value, str):
+        raise ValueError(f'`{key}__{operator}` needs a string value!')
+    # a range over the prefix can use an index, unlike LIKE 'prefix%'
+    upper = prefix_bound(value)
+    if upper is None:
+        return (key, '>=', 1), [value]
+    return (key, 'STARTSWITH', 2), [value, upper]
+
+
+def compile_conditions(args: tuple, kwargs: dict,
+                       operator: str = 'AND',
+                       negated: bool = False) -> Tuple[tuple, list]:
+    shapes = []
+    params: List[Any] = []
+    for key, value in kwargs.items():
+        shape, values = parse_lookup(key, value)
+        shapes.append(shape)
+        params.extend(values)
+    for arg in args:
+        if isinstance(arg, Q):
+            shape, values = arg.compile()
+            shapes.append(shape)
+            params.extend(values)
+        else:
+            shapes.append(('RAW', str(arg)))
+    return (operator, negated, tuple(shapes)), params
+
+
+def condition_keys(shape: tuple) -> Iterator[str]:
+    if shape[0] == 'RAW':
+        return
+    if shape[0] in ('AND', 'OR'):
+        for child in shape[2]:
+            yield from condition_keys(child)
+        return
+    yield shape[0]
+
+
+@lru_cache(maxsize=1024)
+def render_conditions(shape: tuple, table: Union[str, None] = None) -> str:
+    if shape[0] == 'RAW':
+        return shape[1]
+    if shape[0] in ('AND', 'OR'):
+        operator, negated, children = shape
+        if not children:
+            statement = 'true'
+        else:
+            statement = f' {operator} '.join(
+                render_conditions(child, table)
+                for child in children
+            )
+        if negated:
+            return f'NOT ({statement})'
+        return f'({statement})'
+    key, operator, arity = shape
+    if table is not None:
+        key = f'{table}.{key}'
+    if operator == 'IN':
+        placeholders = ', '.join(['?'] * arity)
+        return f'{key} IN ({placeholders})'
+    if operator == 'BETWEEN':
+        return f'{key} BETWEEN ? AND ?'
+    if operator == 'STARTSWITH':
+        return f'({key} >= ? AND {key} < ?)'
+    if not arity:
+        return f'{key} {operator}'
+    return f'{key} {operator} ?'
 
 
-class Operator:
+class Q:
+    operator = 'AND'
+
     def __init__(self, *args, **kwargs):
         self.fields = kwargs
         self.args = args
-        self.operator = self.__class__.__name__
-
-    def generate_statements(self):
-        operator = f' {self.operator} '
-        statements = []
-        for key, value in self.fields.items():
-            if '__' in key:
-                statements.append(self._set_operator_filter(key, value))
-                continue
-            statements.append(f'{key}={repr(value)}')
-        args_statements = operator.join(
-            map(str, self.args))
-        if args_statements:
-            statements.append(args_statements)
-        return f"({operator.join(statements)})"
-
-    @staticmethod
-    def _set_operator_filter(key: str, value: str):
-        filter = key.split('__')
-        if len(filter) != 2:
-            return None
-        key, operator = filter
-        key, operator = key.lower(), operator.lower()
-        if operator in OPERATORS:
-            return (
-                f'{key} {OPERATORS[operator]} {repr(value)}'
-            )
-        elif operator == 'between':
-            start, *_, end = value
-            return (
-                f'{key} BETWEEN {repr(start)} AND {repr(end)}'
+        self.operator = self.__class__.operator
+        self.negated = False
+        self._compiled: Union[Tuple[tuple, list], None] = None
+
+    def compile(self) -> Tuple[tuple, list]:
+        # expressions are immutable once built, so compile them once
+        if self._compiled is None:
+            self._compiled = compile_conditions(
+                self.args, self.fields, self.operator, self.negated,
             )
-        else:
-            return None
+        shape, params = self._compiled
+        return shape, list(params)
+
+    def generate_statements(self) -> Tuple[str, tuple]:
+        shape, params = self.compile()
+        return render_conditions(shape), tuple(params)
+
+    def _combine(self, other: Q, operator: str) -> Q:
+        if not isinstance(other, Q):
+            return NotImplemented
+        combined = Q(self, other)
+        combined.operator = operator
+        return combined
+
+    def __and__(self, other: Q) -> Q:
+        return self._combine(other, 'AND')
+
+    def __or__(self, other: Q) -> Q:
+        return self._combine(other, 'OR')
+
+    def __invert__(self) -> Q:
+        inverted = Q(*self.args, **self.fields)
+        inverted.operator = self.operator
+        inverted.negated = not self.negated
+        return inverted
 
     def __repr__(self) -> str:
-        return self.generate_statements()
+        statement, params = self.generate_statements()
+        return f'{statement} {params}'
 
 
-class AND(Operator):
-    pass
+Operator = Q
 
 
-class OR(Operator):
+class AND(Q):
     pass
 
 
-class NOT(Operator):
+class OR(Q):
+    operator = 'OR'
+
+
+class NOT(Q):
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
-        self.operator = 'AND'
-
-    def __repr__(self) -> str:
-        return f"NOT {super().__repr__()}"
+        self.negated = True
@@ -0,0 +1,617 @@
+from __future__ import annotations
+import json
+from array import array
+from base64 import urlsafe_b64decode, urlsafe_b64encode
+from itertools import islice
+from typing import (
+    Any, AsyncIterator, Dict, Iterator, List, Tuple, Union,
+)
+
+from .aio import executor
+from .columns import TYPECODES
+from .compiler import statements
+from .expressions import Expression, compile_value
+from .operators import (
+    compile_conditions, condition_keys, render_conditions,
+)
+
+
+class QuerySet:
+    def __init__(self, model, fields: Tuple[str, ...] = ()) -> None:
+        self.model = model
+        self.fields = fields
+        self._select_related: Tuple[str, ...] = ()
+        self._prefetch_related: Tuple[str, ...] = ()
+        self._joins: Tuple[str, ...] = ()
+        self._join_params: Tuple[Any, ...] = ()
+        self._where: Tuple[tuple, ...] = ()
+        self._params: Tuple[Any, ...] = ()
+        self._order_by: Tuple[Tuple[str, bool], ...] = ()
+        self._limit: Union[int, None] = None
+        self._offset: Union[int, None] = None
+        self._result_cache: Union[list, None] = None
+        self._cache: Union[bool, None] = None
+        self._page: Union[str, None] = None
+        self._page_window: Union[Tuple[int, Union[int, None]], None] = None
+
+    def _clone(self) -> QuerySet:
+        clone = self.__class__.__new__(self.__class__)
+        clone.__dict__.update(self.__dict__)
+        clone._result_cache = None
+        return clone
+
+    def filter(self, *args, **kwargs) -> QuerySet:
+        where, params = compile_conditions(args, kwargs)
+        for key in condition_keys(where):
+            if key not in self.model.columns:
+                raise ValueError(
+                    f'`{key}` is not a column of {self.model.__name__}!'
+                )
+        clone = self._clone()
+        clone._where = (*self._where, where)
+        clone._params = (*self._params, *params)
+        return clone
+
+    def join(self, clause: str, *params) -> QuerySet:
+        clone = self._clone()
+        clone._joins = (*self._joins, clause)
+        clone._join_params = (*self._join_params, *params)
+        return clone
+
+    def only(self, *fields: str) -> QuerySet:
+        # rows need their id to load the rest, and their version to
+        # detect concurrent updates
+        selected = {'id', self.model._version_column}
+        selected.update(self._check_fields(fields))
+        clone = self._clone()
+        clone.fields = tuple(
+            field for field in self.model.columns if field in selected
+        )
+        return clone
+
+    def defer(self, *fields: str) -> QuerySet:
+        deferred = set(self._check_fields(fields))
+        for field in ('id', self.model._version_column):
+            if field in deferred:
+                raise ValueError(f'The `{field}` column can not be deferred.')
+        clone = self._clone()
+        clone.fields = tuple(
+            field for field in (self.fields or self.model.columns)
+            if field not in deferred
+        )
+        return clone
+
+    def _check_fields(self, fields: Tuple[str, ...]) -> Tuple[str, ...]:
+        fields = tuple(field.lower() for field in fields)
+        for field in fields:
+            if field not in self.model.columns:
+                raise ValueError(
+                    f'`{field}` is not a column of {self.model.__name__}!'
+                )
+        return fields
+
+    def select_related(self, *names: str) -> QuerySet:
+        for name in names:
+            self.model._related_model(name)
+        clone = self._clone()
+        clone._select_related = (*self._select_related, *names)
+        return clone
+
+    def prefetch_related(self, *names: str) -> QuerySet:
+        for name in names:
+            self.model._related_model(name)
+        clone = self._clone()
+        clone._prefetch_related = (*self._prefetch_related, *names)
+        return clone
+
+    def cache(self, enabled: bool = True) -> QuerySet:
+        clone = self._clone()
+        clone._cache = enabled
+        return clone
+
+    def order_by(self, *fields: str) -> QuerySet:
+        clone = self._clone()
+        clone._order_by = tuple(
+            (field[1:], True) if field.startswith('-') else (field, False)
+            for field in fields
+        )
+        return clone
+
+    def limit(self, limit: Union[int, None]) -> QuerySet:
+        clone = self._clone()
+        clone._limit = limit
+        return clone
+
+    def configure(self, config) -> QuerySet:
+        if config is None:
+            return self
+        clone = self._clone()
+        if config.order_by is not None:
+            clone._order_by = ((config.order_by, config.reverse),)
+            if config.order_by != 'id':
+                # ties on the ordering column are broken by id so pages
+                # never overlap or skip rows
+                clone._order_by += (('id', config.reverse),)
+        if config.limit is not None:
+            clone._limit = config.limit
+        if config.after is not None:
+            clone = clone.after(config.after)
+        if config.before is not None:
+            clone = clone.before(config.before)
+        return clone
+
+    def after(self, cursor: str) -> QuerySet:
+        return self._seek(cursor, 'after')
+
+    def before(self, cursor: str) -> QuerySet:
+        return self._seek(cursor, 'before')
+
+    @property
+    def next_cursor(self) -> Union[str, None]:
+        rows = self._fetch()
+        if self._limit is None or not rows:
+            return None
+        if self._page != 'before' and len(rows) < self._limit:
+            return None
+        return self._cursor(rows[-1])
+
+    @property
+    def prev_cursor(self) -> Union[str, None]:
+        rows = self._fetch()
+        if self._limit is None or not rows or self._page is None:
+            return None
+        if self._page == 'before' and len(rows) < self._limit:
+            return None
+        return self._cursor(rows[0])
+
+    def _seek(self, cursor: str, page: str) -> QuerySet:
+        field, reverse = self._order_by[0] if self._order_by else ('id', False)
+        self._check_cursor_field(field)
+        try:
+            name, value, row_id = json.loads(urlsafe_b64decode(cursor))
+        except (ValueError, TypeError):
+            raise ValueError(f'Invalid page cursor: {cursor!r}') from None
+        if name != field:
+            raise ValueError(
+                f'The page cursor was made for `{name}`, not `{field}`.'
+            )
+        backwards = page == 'before'
+        greater = reverse == backwards
+        operator = '>' if greater else '<'
+        table_name = self.model.table_name
+        clone = self._clone()
+        if field == 'id':
+            condition = f'{table_name}.id {operator} ?'
+            params = (row_id,)
+        elif value is None:
+            # NULLs sort before every value, a row value comparison with
+            # them is NULL, so they're matched explicitly
+            column = f'{table_name}.{field}'
+            condition = f'({column} IS NULL AND {table_name}.id {operator} ?)'
+            if greater:
+                condition = f'({condition} OR {column} IS NOT NULL)'
+            params = (row_id,)
+        else:
+            column = f'{table_name}.{field}'
+            condition = f'({column}, {table_name}.id) {operator} (?, ?)'
+            if not greater:
+                condition = f'({condition} OR {column} IS NULL)'
+            params = (value, row_id)
+        clone._where = (*self._where, ('RAW', condition))
+        clone._params = (*self._params, *params)
+        clone._order_by = ((field, reverse),)
+        if field != 'id':
+            clone._order_by += (('id', reverse),)
+        clone._page = page
+        return clone
+
+    def _cursor(self, row: Any) -> str:
+        field = self._order_by[0][0] if self._order_by else 'id'
+        self._check_cursor_field(field)
+        cursor = json.dumps([field, getattr(row, field), row.id])
+        return urlsafe_b64encode(cursor.encode()).decode()
+
+    def _check_cursor_field(self, field: str) -> None:
+        if field not in self.model.columns:
+            raise ValueError(
+                f'Page cursors need ordering by a column of '
+                f'{self.model.__name__}, not `{field}`.'
+            )
+
+    def count(self) -> int:
+        if self._result_cache is not None:
+            return len(self._result_cache)
+        query, params = self._compile('count')
+        return self.model._fetch_result(
+            query, params, self._cache_tables(),
+        )[0]
+
+    def exists(self) -> bool:
+        if self._result_cache is not None:
+            return bool(self._result_cache)
+        query, params = self[:1]._compile('exists')
+        return self.model._fetch_result(
+            query, params, self._cache_tables(),
+        ) is not None
+
+    def first(self) -> Any:
+        if self._result_cache is not None:
+            return self._result_cache[0] if self._result_cache else None
+        rows = list(self[:1])
+        return rows[0] if rows else None
+
+    def last(self) -> Any:
+        if self._result_cache is not None:
+            return self._result_cache[-1] if self._result_cache else None
+        if (self._limit is not None or self._offset is not None or
+                self._page_window is not None):
+            # reversing the order would change which rows are in the slice
+            rows = list(self)
+            return rows[-1] if rows else None
+        clone = self._clone()
+        clone._order_by = tuple(
+            (field, not reverse)
+            for field, reverse in (self._order_by or (('id', False),))
+        )
+        return clone.first()
+
+    def iterator(self, chunk_size: int = 500) -> Iterator[Any]:
+        if self._result_cache is not None:
+            yield from self._result_cache
+            return
+        query, params = self._compile()
+        rows = self.model._fetchmany(
+            query, params, self.fields, chunk_size, self._related_models(),
+        )
+        if not self._prefetch_related:
+            yield from rows
+            return
+        chunk = list(islice(rows, chunk_size))
+        while chunk:
+            self._prefetch(chunk)
+            yield from chunk
+            chunk = list(islice(rows, chunk_size))
+
+    def update(self, **values: Any) -> int:
+        if not values:
+            return 0
+        assignments = []
+        params: List[Any] = []
+        for key, value in values.items():
+            key = key.lower()
+            names = {key}
+            if isinstance(value, Expression):
+                names |= value.references()
+            for name in names:
+                if name not in self.model.columns:
+                    raise ValueError(
+                        f'`{name}` is not a column of '
+                        f'{self.model.__name__}!'
+                    )
+            if key in self.model.foreign_keys:
+                value = getattr(value, 'id', value)
+            statement, value_params = compile_value(value)
+            assignments.append(f'{key} = {statement}')
+            params.extend(value_params)
+        version = self.model._version_column
+        if version is not None and version not in values:
+            # loaded rows holding the old version must notice the change
+            assignments.append(f'{version} = {version} + 1')
+        query, where_params = self._compile('update', ', '.join(assignments))
+        self._result_cache = None
+        return self.model._execute(query, (*params, *where_params)).rowcount
+
+    def delete(self) -> int:
+        query, params = self._compile('delete')
+        self._result_cache = None
+        return self.model._execute(query, params).rowcount
+
+    async def aupdate(self, **values: Any) -> int:
+        return await executor.write(self.update, **values)
+
+    async def adelete(self) -> int:
+        return await executor.write(self.delete)
+
+    def to_columns(self, *fields: str, numpy: bool = False,
+                   chunk_size: int = 10000) -> Dict[str, Any]:
+        fields = self._check_fields(fields) or tuple(self.model.columns)
+        typecodes = [
+            TYPECODES.get(self.model.columns[field].split()[1])
+            for field in fields
+        ]
+        clone = self._clone()
+        clone.fields = fields
+        clone._select_related = ()
+        query, params = clone._compile()
+        columns = self.model._fetch_columns(
+            query, params, typecodes, chunk_size,
+        )
+        if numpy:
+            columns = self._to_numpy(columns)
+        return dict(zip(fields, columns))
+
+    @staticmethod
+    def _to_numpy(columns: List[Union[array, list]]) -> List[Any]:
+        try:
+            import numpy
+        except ImportError:
+            raise ImportError(
+                'to_columns(numpy=True) needs numpy, '
+                'install it with `pip install numpy`.'
+            ) from None
+        return [
+            # typed arrays are wrapped without copying their buffer
+            numpy.frombuffer(values, dtype=values.typecode)
+            if isinstance(values, array)
+            else numpy.array(values, dtype=object)
+            for values in columns
+        ]
+
+    async def ato_columns(self, *fields: str, numpy: bool = False,
+                          chunk_size: int = 10000) -> Dict[str, Any]:
+        return await executor.read(
+            self.to_columns, *fields, numpy=numpy, chunk_size=chunk_size,
+        )
+
+    async def afetch(self) -> QuerySet:
+        await executor.read(self._fetch)
+        return self
+
+    async def acount(self) -> int:
+        return await executor.read(self.count)
+
+    async def aexists(self) -> bool:
+        return await executor.read(self.exists)
+
+    async def afirst(self) -> Any:
+        return await executor.read(self.first)
+
+    async def alast(self) -> Any:
+        return await executor.read(self.last)
+
+    async def aiterator(self, chunk_size: int = 500) -> AsyncIterator[Any]:
+        rows = self.iterator(chunk_size)
+        try:
+            while True:
+                chunk = await executor.read(list, islice(rows, chunk_size))
+                if not chunk:
+                    break
+                for row in chunk:
+                    yield row
+        finally:
+            # releases the held connection if the caller stops early
+            await executor.read(rows.close)
+
+    async def __aiter__(self) -> AsyncIterator[Any]:
+        for row in await executor.read(self._fetch):
+            yield row
+
+    def __getitem__(self, key: Union[int, slice]) -> Any:
+        if self._result_cache is not None:
+            return self._result_cache[key]
+        if isinstance(key, slice):
+            start, stop = key.start or 0, key.stop
+            if start < 0 or (stop is not None and stop < 0):
+                raise ValueError('Negative indexing is not supported.')
+            if key.step not in (None, 1):
+                return list(self)[key]
+            clone = self._clone()
+            if self._page == 'before' and self._page_window is None and \
+                    self._limit is not None:
+                # the page itself stays the rows nearest the cursor, the
+                # slice applies to them in the page's order
+                clone._page_window = (self._limit, self._offset)
+                clone._limit = clone._offset = None
+            offset = clone._offset or 0
+            limit = clone._limit
+            if stop is not None:
+                size = max(stop - start, 0)
+                limit = size if limit is None else min(size, limit - start)
+                limit = max(limit, 0)
+            elif limit is not None:
+                limit = max(limit - start, 0)
+            clone._offset = offset + start or None
+            clone._limit = limit
+            return clone
+        if key < 0:
+            raise ValueError('Negative indexing is not supported.')
+        rows = list(self[key:key + 1])
+        if not rows:
+            raise IndexError('QuerySet index out of range')
+        return rows[0]
+
+    def __iter__(self) -> Iterator[Any]:
+        return iter(self._fetch())
+
+    def __len__(self) -> int:
+        return len(self._fetch())
+
+    def __bool__(self) -> bool:
+        return self.exists()
+
+    def __repr__(self) -> str:
+        return repr(self._fetch())
+
+    def _fetch(self) -> List[Any]:
+        if self._result_cache is None:
+            query, params = self._compile()
+            rows = self.model._fetchall(
+                query, params, self.fields, self._related_models(),
+                self._cache_tables(),
+            )
+            self._prefetch(rows)
+            self._result_cache = rows
+        return self._result_cache
+
+    def _cache_tables(self) -> Tuple[str, ...]:
+        enabled = self._cache
+        if enabled is None:
+            enabled = self.model.cache_results
+        if not enabled:
+            return ()
+        return (
+            self.model.table_name,
+            *(model.table_name for _, model in self._related_models()),
+        )
+
+    def _related_models(self) -> Tuple[Tuple[str, type], ...]:
+        return tuple(
+            (name, self.model._related_model(name))
+            for name in self._select_related
+        )
+
+    def _prefetch(self, rows: List[Any]) -> None:
+        for name in self._prefetch_related:
+            model = self.model._related_model(name)
+            ids = list({
+                getattr(row, name)
+                for row in rows
+                if getattr(row, name) is not None
+            })
+            related = {}
+            # stay below sqlite's limit on bound parameters per statement
+            for start in range(0, len(ids), 900):
+                for item in model.filter(id__in=ids[start:start + 900]):
+                    related[item.id] = item
+            for row in rows:
+                row._set_related(name, related.get(getattr(row, name)))
+
+    def _compile(self, kind: str = 'select',
+                 assignments: str = '') -> Tuple[str, tuple]:
+        # the statement lists every column by position, so two models
+        # sharing a table name must not share it
+        shape = (
+            kind,
+            assignments,
+            self.model.db_name,
+            self.model.table_name,
+            self.fields or tuple(self.model.columns),
+            tuple(
+                (name, model.table_name, tuple(model.columns))
+                for name, model in self._related_models()
+            ),
+            self._joins,
+            self._where,
+            self._order_by,
+            tuple(
+                (limit is not None, offset is not None)
+                for limit, offset in self._slices()
+            ),
+        )
+        query = statements.get(shape, lambda: self._build(kind, assignments))
+        params = [*self._join_params, *self._params]
+        for limit, offset in self._slices():
+            if limit is not None:
+                params.append(limit)
+            if offset is not None:
+                params.append(offset)
+        return query, tuple(params)
+
+    def _slices(self) -> List[Tuple[Union[int, None], Union[int, None]]]:
+        window = self._page_window
+        if window is None and self._page == 'before' and \
+                self._limit is not None:
+            return [(self._limit, self._offset), (None, None)]
+        if window is None:
+            return [(self._limit, self._offset)]
+        return [window, (self._limit, self._offset)]
+
+    def _qualify(self, field: str) -> str:
+        if '.' in field:
+            return field
+        return f'{self.model.table_name}.{field}'
+
+    def _build(self, kind: str, assignments: str = '') -> str:
+        if kind in ('update', 'delete'):
+            return self._build_write(kind, assignments)
+        slices = [
+            (limit is not None, offset is not None)
+            for limit, offset in self._slices()
+        ]
+        if len(slices) == 1:
+            return self._build_select(
+                kind, self._joins, self._where, self._order_by, *slices[0],
+            ) + ';'
+        # a page before the cursor holds the rows nearest to it, so they
+        # are picked reading backwards and then selected in page order
+        ids = self._build_select(
+            'ids', self._joins, self._where,
+            tuple((field, not reverse) for field, reverse in self._order_by),
+            *slices[0],
+        )
+        where = (('RAW', f'{self.model.table_name}.id IN ({ids})'),)
+        return self._build_select(
+            kind, (), where, self._order_by, *slices[1],
+        ) + ';'
+
+    def _build_select(self, kind: str, joins: Tuple[str, ...],
+                      where: Tuple[tuple, ...],
+                      order_by: Tuple[Tuple[str, bool], ...],
+                      limit: bool, offset: bool) -> str:
+        table_name = self.model.table_name
+        sliced = limit or offset
+        if kind == 'select':
+            # rows are built by position, so the column order must not
+            # depend on the order the table's columns were added in
+            columns = ', '.join(
+                f'{table_name}.{field}'
+                for field in self.fields or self.model.columns
+            )
+            for alias, (name, model) in enumerate(self._related_models()):
+                columns += ''.join(
+                    f', related_{alias}.{field}'
+                    for field in model.columns.keys()
+                )
+        elif kind == 'count' and not sliced:
+            columns = 'COUNT(*)'
+        elif kind == 'ids':
+            columns = f'{table_name}.id'
+        else:
+            columns = '1'
+        query = f'SELECT {columns} FROM {table_name}'
+        for join in joins:
+            query += f' {join}'
+        if kind == 'select':
+            for alias, (name, model) in enumerate(self._related_models()):
+                query += (
+                    f' LEFT JOIN {model.table_name} AS related_{alias} '
+                    f'ON related_{alias}.id = {table_name}.{name}'
+                )
+        if where:
+            conditions = render_conditions(('AND', False, where), table_name)
+            query += f' WHERE {conditions}'
+        if order_by and (kind not in ('count', 'ids') or sliced):
+            order_by_sql = ', '.join(
+                f'{self._qualify(field)} DESC'
+                if reverse else f'{self._qualify(field)} ASC'
+                for field, reverse in order_by
+            )
+            query += f' ORDER BY {order_by_sql}'
+        if limit:
+            query += ' LIMIT ?'
+        elif offset:
+            query += ' LIMIT -1'
+        if offset:
+            query += ' OFFSET ?'
+        if kind == 'count' and sliced:
+            query = f'SELECT COUNT(*) FROM ({query})'
+        return query
+
+    def _build_write(self, kind: str, assignments: str) -> str:
+        table_name = self.model.table_name
+        if kind == 'update':
+            query = f'UPDATE {table_name} SET {assignments}'
+        else:
+            query = f'DELETE FROM {table_name}'
+        if (self._joins or self._limit is not None or
+                self._offset is not None or self._page_window is not None):
+            # sqlite can't join or slice in UPDATE/DELETE, so pick the
+            # ids with the same select first
+            ids = self._build('ids')[:-1]
+            query += f' WHERE {table_name}.id IN ({ids})'
+        elif self._where:
+            conditions = render_conditions(
+                ('AND', False, self._where), table_name,
+            )
+            query += f' WHERE {conditions}'
+        return f'{query};'
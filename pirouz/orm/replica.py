@@ -0,0 +1,220 @@
+from __future__ import annotations
+import os
+import sqlite3
+import threading
+from contextlib import contextmanager
+from typing import Dict, Iterator, NamedTuple, Tuple, Union
+from urllib.parse import quote
+
+from .cache import VERSIONS_TABLE
+
+CHANGES_TABLE = 'pirouz_changes'
+KEPT_CHANGES = 10000
+
+
+class ReplicaStats(NamedTuple):
+    reads: int = 0
+    refreshes: int = 0
+    skipped: int = 0
+    reloads: int = 0
+
+
+class Replica:
+    def __init__(self, database: str, table: str) -> None:
+        self.database = database
+        self.table = table
+        self.reads = 0
+        self.refreshes = 0
+        self.skipped = 0
+        self.reloads = 0
+        self._conn: Union[sqlite3.Connection, None] = None
+        self._data_version = None
+        self._version = None
+        self._seq = None
+        self._schema: Tuple[str, ...] = ()
+        self._readers = 0
+        self._lock = threading.Lock()
+        self._idle = threading.Condition(self._lock)
+
+    @contextmanager
+    def connection(self) -> Iterator[sqlite3.Connection]:
+        with self._lock:
+            conn = self._connect()
+            # reads share the copy, a refresh waits for running ones
+            data_version = self._disk_version(conn)
+            while self._readers and data_version != self._data_version:
+                self._idle.wait()
+                conn = self._connect()
+                data_version = self._disk_version(conn)
+            self._refresh(conn, data_version)
+            self.reads += 1
+            self._readers += 1
+        try:
+            yield conn
+        finally:
+            with self._lock:
+                self._readers -= 1
+                if not self._readers:
+                    self._idle.notify_all()
+
+    def stats(self) -> ReplicaStats:
+        with self._lock:
+            return ReplicaStats(
+                self.reads, self.refreshes, self.skipped, self.reloads,
+            )
+
+    def close(self) -> None:
+        with self._lock:
+            while self._readers:
+                self._idle.wait()
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
+                self._data_version = self._version = self._seq = None
+                self._schema = ()
+
+    def _connect(self) -> sqlite3.Connection:
+        if self._conn is None:
+            conn = sqlite3.connect(
+                ':memory:', isolation_level=None, check_same_thread=False,
+                uri=True,
+            )
+            conn.execute(
+                'ATTACH DATABASE ? AS disk;',
+                (f'file:{quote(self.database)}?mode=ro',),
+            )
+            self._conn = conn
+        return self._conn
+
+    @staticmethod
+    def _disk_version(conn: sqlite3.Connection) -> int:
+        return conn.execute('PRAGMA disk.data_version;').fetchone()[0]
+
+    def _refresh(self, conn: sqlite3.Connection, data_version: int) -> None:
+        # data_version moves whenever any other connection commits to the
+        # database file, the table's own version tells whether those
+        # commits touched it.
+        if data_version == self._data_version:
+            return
+        self._data_version = data_version
+        version = self._table_version(conn)
+        if version is not None and version == self._version:
+            self.skipped += 1
+            return
+        conn.execute('BEGIN;')
+        try:
+            schema = tuple(
+                sql for sql, in conn.execute(
+                    'SELECT sql FROM disk.sqlite_master '
+                    "WHERE tbl_name = ? AND type IN ('table', 'index') "
+                    'AND sql IS NOT NULL '
+                    "ORDER BY type = 'index';",
+                    (self.table,),
+                )
+            )
+            seq = self._last_change(conn)
+            if schema != self._schema:
+                conn.execute(f'DROP TABLE IF EXISTS main.{self.table};')
+                for sql in schema:
+                    conn.execute(sql)
+                self._schema = schema
+                self._reload(conn)
+            elif not self._apply_changes(conn):
+                conn.execute(f'DELETE FROM main.{self.table};')
+                self._reload(conn)
+            conn.execute('COMMIT;')
+        except BaseException:
+            conn.execute('ROLLBACK;')
+            self._data_version = None
+            raise
+        self._version = version
+        self._seq = seq
+        self.refreshes += 1
+
+    def _reload(self, conn: sqlite3.Connection) -> None:
+        if self._schema:
+            conn.execute(
+                f'INSERT INTO main.{self.table} '
+                f'SELECT * FROM disk.{self.table};'
+            )
+        self.reloads += 1
+
+    def _apply_changes(self, conn: sqlite3.Connection) -> bool:
+        # only the rows logged since the last refresh are copied again,
+        # unless older entries of the log were pruned in between
+        if self._seq is None:
+            return False
+        try:
+            oldest, = conn.execute(
+                f'SELECT MIN(seq) FROM disk.{CHANGES_TABLE};'
+            ).fetchone()
+        except sqlite3.OperationalError:
+            return False
+        if oldest is None or oldest > self._seq + 1:
+            return False
+        changed = (
+            f'SELECT old_id FROM disk.{CHANGES_TABLE} '
+            'WHERE seq > ? AND name = ? AND old_id IS NOT NULL UNION '
+            f'SELECT new_id FROM disk.{CHANGES_TABLE} '
+            'WHERE seq > ? AND name = ? AND new_id IS NOT NULL'
+        )
+        params = (self._seq, self.table) * 2
+        conn.execute(
+            f'DELETE FROM main.{self.table} WHERE id IN ({changed});', params,
+        )
+        conn.execute(
+            f'INSERT INTO main.{self.table} SELECT * FROM disk.{self.table} '
+            f'WHERE id IN ({changed});',
+            params,
+        )
+        return True
+
+    def _last_change(self, conn: sqlite3.Connection) -> Union[int, None]:
+        try:
+            return conn.execute(
+                f'SELECT MAX(seq) FROM disk.{CHANGES_TABLE};'
+            ).fetchone()[0]
+        except sqlite3.OperationalError:
+            return None
+
+    def _table_version(self, conn: sqlite3.Connection) -> Union[int, None]:
+        try:
+            row = conn.execute(
+                f'SELECT version FROM disk.{VERSIONS_TABLE} WHERE name = ?;',
+                (self.table,),
+            ).fetchone()
+        except sqlite3.OperationalError:
+            return None
+        return row[0] if row else None
+
+
+class ReplicaManager:
+    def __init__(self) -> None:
+        self._replicas: Dict[Tuple[str, str], Replica] = {}
+        self._lock = threading.Lock()
+        self._pid = os.getpid()
+
+    def replica(self, db_name: str, table: str) -> Replica:
+        database = os.path.abspath(db_name)
+        with self._lock:
+            if self._pid != os.getpid():
+                # every worker keeps its own in-memory copy
+                self._replicas = {}
+                self._pid = os.getpid()
+            replica = self._replicas.get((database, table))
+            if replica is None:
+                replica = Replica(database, table)
+                self._replicas[(database, table)] = replica
+            return replica
+
+    def stats(self, db_name: str, table: str) -> ReplicaStats:
+        return self.replica(db_name, table).stats()
+
+    def close_all(self) -> None:
+        with self._lock:
+            replicas, self._replicas = self._replicas, {}
+        for replica in replicas.values():
+            replica.close()
+
+
+replicas = ReplicaManager()
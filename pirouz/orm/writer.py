@@ -0,0 +1,188 @@
+from __future__ import annotations
+import atexit
+import os
+import queue
+import sqlite3
+import threading
+import time
+from concurrent.futures import Future
+from typing import Any, Callable, Dict, List, NamedTuple, Tuple, Union
+
+from .connection import connections
+
+
+class WriterStats(NamedTuple):
+    batches: int = 0
+    writes: int = 0
+    errors: int = 0
+    largest_batch: int = 0
+    queue_latency: float = 0.0
+    max_queue_latency: float = 0.0
+
+    @property
+    def average_batch(self) -> float:
+        if not self.batches:
+            return 0.0
+        return self.writes / self.batches
+
+
+class GroupCommitWriter:
+    def __init__(self, window: float = 0.002, max_batch: int = 256) -> None:
+        self.enabled = False
+        self.window = window
+        self.max_batch = max_batch
+        self.batches = 0
+        self.writes = 0
+        self.errors = 0
+        self.largest_batch = 0
+        self.total_latency = 0.0
+        self.max_latency = 0.0
+        self._queue: queue.SimpleQueue = queue.SimpleQueue()
+        self._thread: Union[threading.Thread, None] = None
+        self._lock = threading.Lock()
+        self._pid = os.getpid()
+        self._exit_hook = False
+
+    def configure(self, enabled: Union[bool, None] = None,
+                  window: Union[float, None] = None,
+                  max_batch: Union[int, None] = None) -> None:
+        if window is not None:
+            self.window = window
+        if max_batch is not None:
+            self.max_batch = max_batch
+        if enabled is not None:
+            self.enabled = enabled
+            if not enabled:
+                self.stop()
+
+    def active(self) -> bool:
+        # the writer thread itself must never wait on its own queue
+        return (self.enabled and
+                threading.current_thread() is not self._thread)
+
+    def submit(self, db_name: str,
+               func: Callable[[sqlite3.Connection], Any]) -> Future:
+        future: Future = Future()
+        with self._lock:
+            self._start()
+            self._queue.put((db_name, func, future, time.monotonic()))
+        return future
+
+    def stop(self) -> None:
+        # writes queued so far are committed before the thread exits
+        with self._lock:
+            thread, self._thread = self._thread, None
+            writes, self._queue = self._queue, queue.SimpleQueue()
+        if thread is not None and thread.is_alive():
+            writes.put(None)
+            thread.join()
+
+    def stats(self) -> WriterStats:
+        with self._lock:
+            return WriterStats(
+                batches=self.batches,
+                writes=self.writes,
+                errors=self.errors,
+                largest_batch=self.largest_batch,
+                queue_latency=(
+                    self.total_latency / self.writes if self.writes else 0.0
+                ),
+                max_queue_latency=self.max_latency,
+            )
+
+    def reset_stats(self) -> None:
+        with self._lock:
+            self.batches = self.writes = self.errors = 0
+            self.largest_batch = 0
+            self.total_latency = self.max_latency = 0.0
+
+    def _start(self) -> None:
+        if self._pid != os.getpid():
+            # the parent's thread and queued writes stay in the parent
+            self._thread = None
+            self._queue = queue.SimpleQueue()
+            self._pid = os.getpid()
+        if self._thread is not None:
+            return
+        self._thread = threading.Thread(
+            target=self._run, args=(self._queue,),
+            name='pirouz-group-commit', daemon=True,
+        )
+        self._thread.start()
+        if not self._exit_hook:
+            atexit.register(self.stop)
+            self._exit_hook = True
+
+    def _run(self, writes: queue.SimpleQueue) -> None:
+        stopping = False
+        while not stopping:
+            item = writes.get()
+            if item is None:
+                break
+            batch = [item]
+            # everything arriving within the window shares one commit
+            deadline = time.monotonic() + self.window
+            while len(batch) < self.max_batch:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    item = writes.get(timeout=timeout)
+                except queue.Empty:
+                    break
+                if item is None:
+                    stopping = True
+                    break
+                batch.append(item)
+            self._commit(batch)
+
+    def _commit(self, batch: List[tuple]) -> None:
+        started = time.monotonic()
+        latencies = [started - enqueued_at for *_, enqueued_at in batch]
+        with self._lock:
+            self.batches += 1
+            self.writes += len(batch)
+            self.largest_batch = max(self.largest_batch, len(batch))
+            self.total_latency += sum(latencies)
+            self.max_latency = max(self.max_latency, *latencies)
+        databases: Dict[str, List[tuple]] = {}
+        for db_name, func, future, _ in batch:
+            databases.setdefault(db_name, []).append((func, future))
+        for db_name, writes in databases.items():
+            self._commit_database(db_name, writes)
+
+    def _commit_database(self, db_name: str,
+                         writes: List[Tuple[Callable, Future]]) -> None:
+        pool = connections.pool(db_name)
+        conn = pool.acquire()
+        outcomes: List[Tuple[Future, bool, Any]] = []
+        try:
+            conn.execute('BEGIN IMMEDIATE;')
+            for func, future in writes:
+                # a failing write is undone alone, the rest still commit
+                conn.execute('SAVEPOINT pirouz_write;')
+                try:
+                    outcomes.append((future, True, func(conn)))
+                except Exception as exc:
+                    conn.execute('ROLLBACK TO pirouz_write;')
+                    outcomes.append((future, False, exc))
+                conn.execute('RELEASE pirouz_write;')
+            conn.execute('COMMIT;')
+        except Exception as exc:
+            if conn.in_transaction:
+                conn.execute('ROLLBACK;')
+            outcomes = [(future, False, exc) for _, future in writes]
+        finally:
+            pool.release(conn)
+        errors = 0
+        for future, succeeded, value in outcomes:
+            if succeeded:
+                future.set_result(value)
+            else:
+                errors += 1
+                future.set_exception(value)
+        with self._lock:
+            self.errors += errors
+
+
+writer = GroupCommitWriter()
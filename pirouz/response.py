@@ -31,6 +31,47 @@ class Render(Response):
         return {}
 
 
+class BlobResponse(Response):
+    def __init__(
+        self,
+        request,
+        model,
+        field,
+        row_id,
+        content_type='application/octet-stream',
+        chunk_size=64 * 1024,
+        **kwargs,
+    ):
+        size = model.blob_size(field, row_id)
+        if size is None:
+            super().__init__('Not Found', status=404, **kwargs)
+            return
+        start, stop, status = 0, size, 200
+        byte_range = request.range
+        # multiple ranges aren't supported, those get the whole blob
+        if byte_range is not None and len(byte_range.ranges) == 1:
+            bounds = byte_range.range_for_length(size)
+            if bounds is None:
+                super().__init__(status=416, **kwargs)
+                self.headers['Content-Range'] = f'bytes */{size}'
+                return
+            start, stop = bounds
+            status = 206
+        super().__init__(
+            model.read_blob(field, row_id, start, stop, chunk_size),
+            status=status,
+            content_type=content_type,
+            direct_passthrough=True,
+            **kwargs,
+        )
+        self.headers['Accept-Ranges'] = 'bytes'
+        self.content_length = stop - start
+        if status == 206:
+            self.headers['Content-Range'] = (
+                f'bytes {start}-{stop - 1}/{size}'
+            )
+
+
 def redirect(url: str) -> Response:
     response = RequestRedirect(url)
     return response.get_response()
@@ -0,0 +1,1036 @@
+"""
+pytest pirouz/test/ -v
+"""
+
+import threading
+import time
+
+import pytest
+
+from pirouz import DB, columns, OR, NOT
+from pirouz.orm import connections, statements
+
+
+@pytest.fixture
+def models(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+
+    class User(DB):
+        username = columns.VarChar(unique=True, nullable=False)
+        email = columns.Text()
+
+    class Post(DB):
+        title = columns.Text(nullable=False)
+        body = columns.Text()
+        author = columns.ForeignKey(User)
+        like_count = columns.SmallInt(default=0)
+
+    yield User, Post
+    connections.close_all()
+
+
+def test_connections_are_reused(models):
+    User, Post = models
+    User(username='dori', email='dori@example.com')
+    before = connections.stats(User.db_name)
+    for _ in range(10):
+        list(User.filter(username='dori'))
+    after = connections.stats(User.db_name)
+    assert after.misses == before.misses
+    assert after.hits == before.hits + 10
+    assert after.in_use == 0
+
+
+def test_connections_are_per_thread(models):
+    User, Post = models
+    pool = connections.pool(User.db_name)
+    seen = []
+
+    def worker():
+        with connections.connection(User.db_name) as conn:
+            seen.append(conn)
+            barrier.wait()
+
+    barrier = threading.Barrier(2)
+    threads = [threading.Thread(target=worker) for _ in range(2)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert seen[0] is not seen[1]
+    assert pool.stats().idle >= 2
+
+
+def test_idle_connections_are_recycled(models):
+    User, Post = models
+    connections.configure(recycle=0)
+    try:
+        list(User.filter(username='dori'))
+        list(User.filter(username='dori'))
+        assert connections.stats(User.db_name).recycled >= 1
+    finally:
+        connections.configure(recycle=300.0)
+
+
+def test_filter_values_are_parameterized(models):
+    User, Post = models
+    User(username="o'reilly", email=None)
+    User(username='dori', email='dori@example.com')
+    assert User.filter(username="o'reilly").count() == 1
+    assert User.filter(username="x' OR '1'='1").count() == 0
+    assert User.filter(username__in=['dori', "o'reilly"]).count() == 2
+    rows = User.filter(OR(username='dori', email='none'), NOT(id=1))
+    assert [row.username for row in rows] == ['dori']
+
+
+def test_statement_cache_is_keyed_by_query_shape(models):
+    User, Post = models
+    list(User.filter(username='first'))
+    before = statements.stats()
+    list(User.filter(username='second'))
+    list(User.filter(username='third'))
+    after = statements.stats()
+    assert after.hits == before.hits + 2
+    assert after.misses == before.misses
+
+
+def test_queryset_is_lazy_and_chainable(models):
+    User, Post = models
+    for number in range(5):
+        Post(title=f'post {number}', like_count=number)
+    queries = Post.queries()
+    posts = Post.filter(like_count__gte=1).order_by('-like_count')
+    assert Post.queries() == queries
+    assert [post.title for post in posts.limit(2)] == ['post 4', 'post 3']
+    assert [post.like_count for post in posts[1:3]] == [3, 2]
+    assert posts[0].title == 'post 4'
+
+
+def test_queryset_pushes_aggregates_down_to_sql(models):
+    User, Post = models
+    for number in range(5):
+        Post(title=f'post {number}')
+    assert Post.all().count() == 5
+    assert Post.queries().endswith('SELECT COUNT(*) FROM post;')
+    assert Post.all()[1:4].count() == 3
+    assert Post.all().first().title == 'post 0'
+    assert Post.all().last().title == 'post 4'
+    assert 'LIMIT ?' in Post.queries().splitlines()[-1]
+    assert Post.filter(title='missing').first() is None
+
+
+def test_iterator_streams_rows_over_one_connection(models):
+    User, Post = models
+    for number in range(7):
+        Post(title=f'post {number}')
+    rows = Post.all().order_by('id').iterator(chunk_size=3)
+    first = next(rows)
+    assert first.title == 'post 0'
+    assert connections.stats(Post.db_name).in_use == 1
+    assert [row.title for row in rows][-1] == 'post 6'
+    assert connections.stats(Post.db_name).in_use == 0
+
+
+def test_bulk_create_returns_ids_in_one_transaction(models):
+    User, Post = models
+    author = User(username='dori')
+    Post(title='existing')
+    ids = Post.bulk_create(
+        [{'title': f'post {number}', 'author': author}
+         for number in range(5)] + [{'id': 50, 'title': 'explicit'}],
+        batch_size=2,
+    )
+    assert ids == [2, 3, 4, 5, 6, 50]
+    assert [post.id for post in Post.filter(title__like='post%')] == ids[:5]
+    assert Post.filter(id=4).first().author == author.id
+    with pytest.raises(Exception):
+        Post.bulk_create([{'title': 'dup 1'}, {'id': 2, 'title': 'dup 2'}])
+    assert Post.filter(title='dup 1').count() == 0
+
+
+def test_insert_takes_id_from_sqlite(models):
+    User, Post = models
+    first = User(username='first')
+    second = User(username='second')
+    duplicate = User(username='first')
+    assert (first.id, second.id, duplicate.id) == (1, 2, None)
+
+
+def test_transaction_commits_once_and_nests_with_savepoints(models):
+    User, Post = models
+    with DB.transaction():
+        author = User(username='dori')
+        Post(title='kept', author=author)
+        with pytest.raises(ValueError):
+            with DB.transaction():
+                Post(title='rolled back')
+                raise ValueError
+        assert connections.stats(Post.db_name).in_use == 1
+    assert connections.stats(Post.db_name).in_use == 0
+    assert [post.title for post in Post.all()] == ['kept']
+    with pytest.raises(ValueError):
+        with DB.transaction():
+            User(username='ghost')
+            raise ValueError
+    assert User.filter(username='ghost').count() == 0
+
+
+def test_transaction_middleware_wraps_each_request(models):
+    from requests import Session
+    from wsgiadapter import WSGIAdapter
+    from pirouz import App, TextResponse, TransactionMiddleware
+
+    User, Post = models
+    app = App(__file__)
+    app.add_middleware(TransactionMiddleware)
+
+    @app.route('/create/<title>/')
+    def create(request, title):
+        Post(title=title)
+        if title == 'broken':
+            raise ValueError
+        return TextResponse(str(connections.in_transaction()))
+
+    client = Session()
+    client.mount('http://testserver', WSGIAdapter(app))
+    assert client.get('http://testserver/create/fine/').text == 'True'
+    with pytest.raises(ValueError):
+        client.get('http://testserver/create/broken/')
+    assert [post.title for post in Post.all()] == ['fine']
+
+
+def test_update_and_remove_target_the_primary_key(models):
+    User, Post = models
+    post = Post(title='draft', body='x' * 1000)
+    post.update(title='published')
+    assert post.title == 'published'
+    assert Post.queries().splitlines()[-1].startswith(
+        'UPDATE post SET title = ? WHERE id = ?;'
+    )
+    row = Post.filter(id=post.id).first()
+    row.update(like_count=3)
+    assert row.like_count == 3
+    assert Post.filter(id=post.id).first().like_count == 3
+    row.remove()
+    assert Post.all().count() == 0
+
+
+def test_versioned_rows_detect_concurrent_writes(tmp_path, monkeypatch):
+    from pirouz.orm import StaleRowError
+
+    monkeypatch.chdir(tmp_path)
+
+    class Page(DB):
+        title = columns.Text()
+        version = columns.Version()
+
+    page = Page(title='first')
+    stale = Page.filter(id=page.id).first()
+    page.update(title='second')
+    assert page.version == 1
+    with pytest.raises(StaleRowError):
+        stale.update(title='conflict')
+    with pytest.raises(StaleRowError):
+        stale.remove()
+    assert Page.filter(id=page.id).first().title == 'second'
+    connections.close_all()
+
+
+def test_rows_are_slotted_per_model_classes(models):
+    User, Post = models
+    author = User(username='dori')
+    Post(title='hello', author=author)
+    user = User.all().first()
+    post = Post.all().first()
+    assert type(user)._model is User and type(post)._model is Post
+    assert user.table_name == 'user'
+    assert not hasattr(post, '__dict__')
+    assert post.data['title'] == 'hello' and post.author == author.id
+    user.update(email='dori@example.com')
+    assert user.email == 'dori@example.com'
+    assert User.filter(email='dori@example.com').count() == 1
+
+
+def test_row_metadata_leaves_room_for_any_column(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+
+    class Car(DB):
+        model = columns.VarChar()
+        fields = columns.Text()
+
+    Car(model='fiat', fields='x')
+    car = Car.all().first()
+    assert repr(car) == "<'id':1, 'model':'fiat', 'fields':'x'>"
+    car.update(model='bmw')
+    assert Car.filter(model='bmw').count() == 1
+    with pytest.raises(ValueError, match='Row.update'):
+        type('Task', (DB,), {'update': columns.Text()})
+    connections.close_all()
+
+
+def test_declared_indexes_are_synced_idempotently(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+
+    def define(declared_indexes):
+        class Article(DB):
+            title = columns.Text(index=True)
+            author = columns.Integer()
+            created = columns.Date()
+            indexes = declared_indexes
+        return Article
+
+    Article = define([
+        columns.Index('author', 'created'),
+        columns.Index('title', unique=True, where='author IS NOT NULL'),
+    ])
+    assert set(Article._current_indexes()) == {
+        'ix_article_title',
+        'ix_article_author_created',
+        'ux_article_title',
+    }
+    plan = Article._fetch_result(
+        'EXPLAIN QUERY PLAN SELECT * FROM article WHERE author = ?;', (1,),
+    )
+    assert 'ix_article_author_created' in plan[-1]
+    queries = Article.queries()
+    Article._manage_table()
+    assert 'INDEX' not in Article.queries()[len(queries):]
+    Article = define([columns.Index('author')])
+    assert set(Article._current_indexes()) == {
+        'ix_article_title',
+        'ix_article_author',
+    }
+    connections.close_all()
+
+
+def test_full_text_search_is_kept_in_sync(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+
+    class Note(DB):
+        title = columns.Text()
+        body = columns.Text()
+        search_fields = ('title', 'body')
+
+    Note(title='sqlite tips', body='use an index')
+    Note(title='python', body='sqlite sqlite sqlite')
+    removed = Note(title='sqlite removed', body='')
+    removed.remove()
+    Note.filter(title='python').first().update(title='python and sqlite')
+    results = Note.search('sqlite')
+    assert results.count() == 2
+    assert results.first().title == 'python and sqlite'
+    assert [note.title for note in Note.search('sql ind')] == ['sqlite tips']
+    assert Note.search('"unbalanced').count() == 0
+    assert list(Note.search('')) == []
+    assert Note.search('   ').count() == 0
+    with pytest.raises(ValueError, match='fts.fts_rank'):
+        Note.search('sqlite').limit(1).next_cursor
+    assert Note.search('sqlite', rank=False).filter(id=1).count() == 1
+    with connections.connection(Note.db_name) as conn:
+        # a database synced before updates were narrowed to these columns
+        conn.execute('DROP TRIGGER note_fts_au;')
+        conn.execute(
+            'CREATE TRIGGER note_fts_au AFTER UPDATE ON note BEGIN '
+            'SELECT 1; END;'
+        )
+        conn.execute("UPDATE pirouz_schema SET fingerprint = 'old';")
+
+    class Note(DB):
+        title = columns.Text()
+        body = columns.Text()
+        search_fields = ('title', 'body')
+
+    with connections.connection(Note.db_name) as conn:
+        trigger, = conn.execute(
+            "SELECT sql FROM sqlite_master WHERE name = 'note_fts_au';"
+        ).fetchone()
+    assert 'AFTER UPDATE OF title, body ON note' in trigger
+    assert Note.search('python').count() == 1
+    connections.close_all()
+
+
+def test_select_related_joins_foreign_keys(models):
+    User, Post = models
+    author = User(username='dori')
+    Post(title='with author', author=author)
+    Post(title='anonymous')
+    queries = Post.queries()
+    posts = list(Post.all().select_related('author').order_by('id'))
+    assert Post.queries()[len(queries):].count('SELECT') == 1
+    assert posts[0].related('author').username == 'dori'
+    assert posts[0].author == author.id
+    assert posts[1].related('author') is None
+    assert Post.filter(id=1).select_related('author').count() == 1
+    with pytest.raises(ValueError):
+        Post.all().select_related('title')
+
+
+def test_prefetch_related_batches_foreign_keys(models):
+    User, Post = models
+    authors = [User(username=f'user {number}') for number in range(3)]
+    for number in range(6):
+        Post(title=f'post {number}', author=authors[number % 3])
+    queries = User.queries()
+    posts = list(Post.all().prefetch_related('author'))
+    names = [post.related('author').username for post in posts]
+    assert names == ['user 0', 'user 1', 'user 2'] * 2
+    assert User.queries()[len(queries):].count('IN (?, ?, ?)') == 1
+    streamed = Post.all().prefetch_related('author').iterator(chunk_size=4)
+    assert [post.related('author').id for post in streamed] == [1, 2, 3] * 2
+
+
+@pytest.fixture
+def cached_results():
+    from pirouz.orm import results
+
+    results.configure(enabled=True, ttl=60)
+    yield results
+    results.configure(enabled=False)
+
+
+def test_result_cache_is_invalidated_by_writes(models, cached_results):
+    User, Post = models
+    Post(title='first')
+    posts = Post.all().cache()
+    assert posts.count() == 1
+    queries = Post.queries()
+    assert Post.all().cache().count() == 1
+    assert [post.title for post in Post.all().cache()] == ['first']
+    assert [post.title for post in Post.all().cache()] == ['first']
+    assert cached_results.stats().hits == 2
+    Post(title='second')
+    assert Post.all().cache().count() == 2
+    assert len(Post.all().cache()) == 2
+    assert Post.queries()[len(queries):].count('SELECT') == 3
+    with DB.transaction():
+        Post.filter(id=1).first().update(title='changed')
+        assert Post.all().cache().first().title == 'changed'
+    assert Post.all().cache().first().title == 'changed'
+
+
+def test_result_cache_sees_writes_from_other_processes(models,
+                                                       cached_results):
+    import sqlite3
+
+    User, Post = models
+    Post(title='first')
+    assert Post.all().cache().count() == 1
+    # another worker writes through its own connection and bumps the
+    # shared version counter
+    conn = sqlite3.connect(Post.db_name)
+    conn.execute("INSERT INTO post (title) VALUES ('other worker')")
+    conn.execute(
+        "UPDATE pirouz_versions SET version = version + 1 "
+        "WHERE name = 'post'"
+    )
+    conn.commit()
+    conn.close()
+    assert Post.all().cache().count() == 2
+
+
+def test_unchanged_schema_skips_sync(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+
+    def define(*, with_email):
+        class Member(DB):
+            name = columns.Text(index=True)
+            if with_email:
+                email = columns.Text()
+        return Member
+
+    Member = define(with_email=False)
+    Member(name='dori')
+    queries = define(with_email=False).queries().splitlines()
+    assert len(queries) == 1
+    assert 'pirouz_schema' in queries[0]
+    Member = define(with_email=True)
+    assert Member._get_current_table_columns() == ['id', 'name', 'email']
+    assert Member.filter(name='dori').count() == 1
+    connections.close_all()
+
+
+def test_rows_match_columns_after_sync_appends_one(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+
+    def define(*names):
+        return type('Item', (DB,), {name: columns.Text() for name in names})
+
+    define('a', 'c')(a='a', c='c')
+    Item = define('a', 'b', 'c')
+    assert Item._get_current_table_columns() == ['id', 'a', 'c', 'b']
+    for item in (Item.all().first(), Item.first(), Item.last()):
+        assert (item.a, item.b, item.c) == ('a', None, 'c')
+    connections.close_all()
+
+
+def test_same_table_in_two_databases(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+
+    def define(db, **fields):
+        class Author(DB):
+            db_name = db
+            name = columns.Text()
+
+        namespace = {'db_name': db, 'author': columns.ForeignKey(Author)}
+        namespace.update(fields)
+        return type('Comment', (DB,), namespace)
+
+    Blog = define('blog.db', body=columns.Text())
+    Shop = define('shop.db', rating=columns.Integer(),
+                  stars=columns.Text())
+    Blog(body='great')
+    Shop(rating=5, stars='five')
+    assert Blog.all().first().data == {'id': 1, 'author': None,
+                                       'body': 'great'}
+    assert Shop.all().first().data == {'id': 1, 'author': None,
+                                       'rating': 5, 'stars': 'five'}
+    assert Shop._related_model('author').db_name == 'shop.db'
+    shop = Shop.all().select_related('author').first()
+    assert shop.related('author') is None
+    connections.close_all()
+
+
+def test_lazy_sync_defers_table_creation(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+
+    class Draft(DB):
+        title = columns.Text()
+        lazy_sync = True
+
+    assert Draft.queries() == ''
+    assert Draft._get_current_table_columns() == []
+    assert Draft.all().count() == 0
+    assert Draft._get_current_table_columns() == ['id', 'title']
+    connections.close_all()
+
+
+def test_lazy_sync_makes_other_threads_wait(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+
+    class Draft(DB):
+        title = columns.Text()
+        lazy_sync = True
+
+    manage_table = Draft._manage_table
+    started = threading.Event()
+
+    def slow_manage_table():
+        started.set()
+        time.sleep(0.1)
+        return manage_table()
+
+    monkeypatch.setattr(Draft, '_manage_table', slow_manage_table)
+    counts, errors = [], []
+
+    def count():
+        try:
+            counts.append(Draft.all().count())
+        except Exception as exc:
+            errors.append(exc)
+
+    first = threading.Thread(target=count)
+    first.start()
+    started.wait()
+    count()
+    first.join()
+    assert errors == []
+    assert counts == [0, 0]
+    connections.close_all()
+
+
+def test_keyset_pagination_with_cursors(models):
+    from pirouz import ResultConfig
+
+    User, Post = models
+    Post.bulk_create(
+        {'title': f'post {number}', 'like_count': number // 2}
+        for number in range(7)
+    )
+    config = ResultConfig(limit=3, order_by='like_count', reverse=True)
+    page = Post.all(config=config)
+    assert [post.id for post in page] == [7, 6, 5]
+    assert page.prev_cursor is None
+    page = Post.all(config=config._replace(after=page.next_cursor))
+    assert [post.id for post in page] == [4, 3, 2]
+    last_page = Post.all(config=config._replace(after=page.next_cursor))
+    assert [post.id for post in last_page] == [1]
+    assert last_page.next_cursor is None
+    previous = Post.all(config=config._replace(before=last_page.prev_cursor))
+    assert [post.id for post in previous] == [4, 3, 2]
+    assert 'OFFSET' not in Post.queries()
+    before = config._replace(before=last_page.prev_cursor)
+    assert Post.all(config=before).first().id == 4
+    assert Post.all(config=before).last().id == 2
+    assert Post.all(config=before)[1].id == 3
+    assert [post.id for post in Post.all(config=before)[1:]] == [3, 2]
+    assert Post.all(config=before)[1:].count() == 2
+    assert [post.id for post in Post.all(config=before).iterator()] == [
+        4, 3, 2,
+    ]
+    assert list(Post.all(config=before).to_columns('id')['id']) == [4, 3, 2]
+    by_id = Post.all().order_by('id').limit(4)
+    assert [post.id for post in by_id.after(by_id.next_cursor)] == [5, 6, 7]
+    with pytest.raises(ValueError):
+        Post.all(config=config._replace(after='garbage'))
+
+
+def test_keyset_pagination_keeps_rows_with_nulls(models):
+    from pirouz import ResultConfig
+
+    User, Post = models
+    Post.bulk_create(
+        {'title': f'post {number}',
+         'like_count': None if number % 3 == 0 else number % 4}
+        for number in range(30)
+    )
+    for reverse in (False, True):
+        prefix = '-' if reverse else ''
+        ordered = Post.all().order_by(f'{prefix}like_count', f'{prefix}id')
+        expected = [post.id for post in ordered]
+        config = ResultConfig(limit=4, order_by='like_count', reverse=reverse)
+        pages = [Post.all(config=config)]
+        while pages[-1].next_cursor is not None:
+            pages.append(Post.all(
+                config=config._replace(after=pages[-1].next_cursor),
+            ))
+        assert [post.id for page in pages for post in page] == expected
+        for page, previous in zip(pages[1:], pages):
+            before = Post.all(config=config._replace(before=page.prev_cursor))
+            assert [post.id for post in before] == [
+                post.id for post in previous
+            ]
+
+
+def test_async_api_runs_queries_off_the_event_loop(models):
+    import asyncio
+
+    User, Post = models
+
+    async def main():
+        author = await User.acreate(username='dori')
+        await Post.abulk_create(
+            {'title': f'post {number}', 'author': author}
+            for number in range(5)
+        )
+        posts = await Post.afilter(author=author.id)
+        assert len(posts) == 5
+        assert await Post.all().acount() == 5
+        first = await Post.all().afirst()
+        await first.aupdate(title='renamed')
+        assert [post.title async for post in Post.filter(id=1)] == [
+            'renamed'
+        ]
+        titles = [
+            post.title
+            async for post in Post.all().aiterator(chunk_size=2)
+        ]
+        assert titles[1:] == [f'post {number}' for number in range(1, 5)]
+        await author.aremove()
+        assert not await User.all().aexists()
+
+    asyncio.run(main())
+
+
+def test_pragmas_apply_to_every_pooled_connection(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    connections.configure(pragmas={'journal_mode': 'wal'})
+    try:
+        class Entry(DB):
+            title = columns.Text()
+
+        class Log(DB):
+            db_name = 'log.db'
+            pragmas = {'journal_mode': 'delete', 'busy_timeout': 1234}
+            message = columns.Text()
+
+        with connections.connection(Entry.db_name) as conn:
+            assert conn.execute('PRAGMA journal_mode;').fetchone()[0] == 'wal'
+        with connections.connection(Log.db_name) as conn:
+            assert conn.execute(
+                'PRAGMA journal_mode;'
+            ).fetchone()[0] == 'delete'
+            assert conn.execute('PRAGMA busy_timeout;').fetchone()[0] == 1234
+        with pytest.raises(ValueError):
+            connections.configure(pragmas={'journal_mode': 'wal; DROP'})
+        with pytest.raises(ValueError):
+            connections.configure(pragmas={'writable_schema': 1})
+    finally:
+        connections.configure(pragmas={})
+        connections.close_all()
+
+
+def test_query_log_is_bounded_and_records_slow_queries(models, caplog):
+    from pirouz.orm import query_log
+
+    User, Post = models
+    query_log.configure(max_entries=5, slow_threshold=0)
+    try:
+        for number in range(10):
+            Post(title=f'post {number}')
+        assert len(query_log.entries()) == 5
+        assert len(Post.queries().split('\n\n')) == 5
+        entry = query_log.entries(Post)[-1]
+        assert entry.table == 'post'
+        assert entry.rows == 1
+        assert entry.duration >= 0
+        assert entry.caller.startswith(__file__)
+        list(Post.filter(title='post 1'))
+        assert query_log.entries()[-1].rows == 1
+        assert query_log.slow()[-1] == query_log.entries()[-1]
+        assert 'Slow query' in caplog.text
+        Post(title='post', body='long ' * 100)
+        assert query_log.entries()[-1].params[:2] == (
+            'post', '<str of length 500>',
+        )
+    finally:
+        query_log.configure(max_entries=1000, slow_threshold=None)
+        query_log.clear()
+
+
+def test_query_count_middleware_counts_per_request(models):
+    from requests import Session
+    from wsgiadapter import WSGIAdapter
+    from pirouz import App, TextResponse, QueryCountMiddleware
+
+    User, Post = models
+    app = App(__file__)
+    app.add_middleware(QueryCountMiddleware)
+
+    @app.route('/posts/')
+    def posts(request):
+        Post(title='hello')
+        return TextResponse(str(Post.all().count()))
+
+    client = Session()
+    client.mount('http://testserver', WSGIAdapter(app))
+    response = client.get('http://testserver/posts/')
+    assert response.headers['X-Query-Count'] == '2'
+    assert float(response.headers['X-Query-Time']) >= 0
+    response = client.get('http://testserver/posts', allow_redirects=False)
+    assert response.status_code == 308
+    assert response.headers['X-Query-Count'] == '0'
+
+
+def test_advisor_suggests_indexes_for_scanned_tables(models):
+    from pirouz.orm import advisor
+
+    User, Post = models
+    Post.bulk_create({'title': f'post {number}'} for number in range(50))
+    with advisor.profile(min_rows=10):
+        for _ in range(3):
+            list(Post.filter(title='post 1', like_count__gt=0))
+        list(Post.all().order_by('-like_count').limit(5))
+        Post.get('title').filter(id=1).first()
+        list(User.filter(username='dori'))
+    try:
+        assert not advisor.enabled
+        report = advisor.report()
+        assert [(item.table, item.columns, item.executions)
+                for item in report] == [
+            ('post', ('title', 'like_count'), 3),
+            ('post', ('like_count',), 1),
+        ]
+        assert report[0].rows == 50
+        assert "columns.Index('title', 'like_count')" in (
+            advisor.format_report()
+        )
+        assert any(
+            'SEARCH' in detail
+            for plan in advisor.plans() if 'id =' in plan.sql
+            for detail in plan.details
+        )
+    finally:
+        advisor.clear()
+
+
+def test_memory_replica_serves_reads_and_follows_writes(tmp_path,
+                                                         monkeypatch):
+    import sqlite3
+    from pirouz.orm import replicas
+
+    monkeypatch.chdir(tmp_path)
+
+    class Account(DB):
+        name = columns.Text(index=True)
+        memory_replica = True
+
+    class Event(DB):
+        db_name = Account.db_name
+        title = columns.Text()
+
+    try:
+        Account(name='dori')
+        assert [account.name for account in Account.all()] == ['dori']
+        assert Account.filter(name='dori').count() == 1
+        stats = replicas.stats(Account.db_name, 'account')
+        assert stats.reads == 2
+        assert stats.refreshes == 1
+        Event(title='login')
+        assert Account.all().count() == 1
+        assert replicas.stats(Account.db_name, 'account').skipped == 1
+        with DB.transaction():
+            Account(name='sara')
+            assert Account.all().count() == 2
+        assert replicas.stats(Account.db_name, 'account').reads == 3
+        assert Account.all().count() == 2
+        conn = sqlite3.connect(Account.db_name)
+        with conn:
+            conn.execute("INSERT INTO account (name) VALUES ('reza');")
+        conn.close()
+        assert Account.all().count() == 3
+        assert replicas.stats(Account.db_name, 'account').refreshes == 3
+        Account.filter(name='reza').update(name='reza2')
+        Account.filter(name='dori').delete()
+        assert sorted(account.name for account in Account.all()) == [
+            'reza2', 'sara',
+        ]
+        stats = replicas.stats(Account.db_name, 'account')
+        assert (stats.refreshes, stats.reloads) == (4, 1)
+        replica = replicas.replica(Account.db_name, 'account')
+        counts = []
+        with replica.connection():
+            # a running read doesn't hold up others on the same copy
+            reader = threading.Thread(
+                target=lambda: counts.append(Account.all().count()),
+            )
+            reader.start()
+            reader.join(timeout=5)
+        assert counts == [2]
+    finally:
+        replicas.close_all()
+        connections.close_all()
+
+
+def test_to_columns_fetches_compact_arrays(models):
+    from array import array
+
+    User, Post = models
+    user = User(username='dori')
+    Post.bulk_create(
+        {'title': f'post {number}', 'like_count': number,
+         'author': user.id if number % 2 else None}
+        for number in range(5)
+    )
+    columns = Post.filter(like_count__gte=1).to_columns(
+        'id', 'like_count', 'author', 'title', chunk_size=2,
+    )
+    assert columns['like_count'] == array('q', [1, 2, 3, 4])
+    assert isinstance(columns['id'], array)
+    assert columns['author'] == [1, None, 1, None]
+    assert columns['title'] == ['post 1', 'post 2', 'post 3', 'post 4']
+    assert list(Post.all().to_columns()) == list(Post.columns)
+    with pytest.raises(ValueError):
+        Post.all().to_columns('missing')
+    try:
+        import numpy
+    except ImportError:
+        with pytest.raises(ImportError):
+            Post.all().to_columns('like_count', numpy=True)
+    else:
+        likes = Post.all().to_columns('like_count', numpy=True)['like_count']
+        assert isinstance(likes, numpy.ndarray)
+        assert likes.sum() == 10
+
+
+def test_queryset_update_and_delete_are_set_based(models, cached_results):
+    from pirouz import F
+
+    User, Post = models
+    user = User(username='dori')
+    Post.bulk_create(
+        {'title': f'post {number}', 'like_count': number}
+        for number in range(6)
+    )
+    cached = Post.all().cache()
+    assert len(list(cached)) == 6
+    liked = Post.filter(like_count__gte=3)
+    assert liked.update(like_count=F('like_count') * 2 + 1, author=user) == 3
+    assert 'UPDATE post SET' in Post.queries().splitlines()[-1]
+    assert [post.like_count for post in Post.all().cache()] == [
+        0, 1, 2, 7, 9, 11,
+    ]
+    assert Post.filter(author=user.id).count() == 3
+    assert Post.all().order_by('-like_count')[:2].update(title='top') == 2
+    assert [post.id for post in Post.filter(title='top')] == [5, 6]
+    assert Post.filter(like_count__lt=2).delete() == 2
+    assert Post.all().count() == 4
+    with pytest.raises(ValueError):
+        Post.all().update(missing=1)
+    with pytest.raises(ValueError):
+        Post.all().update(like_count=F('missing'))
+
+
+def test_group_commit_writer_coalesces_writes(models):
+    import sqlite3
+    from pirouz.orm import writer
+
+    User, Post = models
+    Post.all().count()
+    writer.configure(enabled=True, window=0.05)
+    writer.reset_stats()
+    try:
+        barrier = threading.Barrier(8)
+
+        def create(number):
+            barrier.wait()
+            Post(title=f'post {number}')
+
+        threads = [
+            threading.Thread(target=create, args=(number,))
+            for number in range(8)
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        futures = [
+            Post.enqueue(title=f'queued {number}') for number in range(3)
+        ]
+
+        def broken(conn):
+            conn.execute('INSERT INTO missing VALUES (1);')
+        failed = writer.submit(Post.db_name, broken)
+        assert sorted(future.result() for future in futures) == [9, 10, 11]
+        with pytest.raises(sqlite3.OperationalError):
+            failed.result()
+        stats = writer.stats()
+        assert stats.writes == 12
+        assert stats.batches < stats.writes
+        assert stats.errors == 1
+        assert stats.average_batch > 1
+    finally:
+        writer.configure(enabled=False)
+    assert Post.all().count() == 11
+
+
+def test_q_expressions_compile_once_to_parameterized_sql(models):
+    from pirouz import Q
+
+    User, Post = models
+    for name in ('dori', 'doris', 'sara', 'reza'):
+        User(username=name, email=None if name == 'reza' else f'{name}@x')
+
+    def names(users):
+        return sorted(user.username for user in users)
+
+    query = Q(username='dori') | Q(username__startswith='sa')
+    assert names(User.filter(query)) == ['dori', 'sara']
+    assert names(User.filter(~query & Q(email__isnull=False))) == ['doris']
+    assert names(User.filter(email__isnull=True)) == ['reza']
+    assert names(User.filter(username__startswith='dor')) == [
+        'dori', 'doris',
+    ]
+    assert names(User.filter(id__in=[1, 3], username__between=('a', 'r'))) \
+        == ['dori']
+    assert names(User.filter(NOT(OR(username='dori', username__in=())))) \
+        == ['doris', 'reza', 'sara']
+    before = statements.stats().hits
+    list(User.filter(Q(username='x') | Q(username__startswith='y')))
+    assert statements.stats().hits == before + 1
+    statement, params = (Q(email__isnull=True) & ~Q(id__gt=2)) \
+        .generate_statements()
+    assert statement == '((email IS NULL) AND NOT (id > ?))'
+    assert params == (2,)
+    query, params = User.filter(username__startswith='do')._compile()
+    with connections.connection(User.db_name) as conn:
+        plan = conn.execute(f'EXPLAIN QUERY PLAN {query}', params).fetchall()
+    assert 'USING INDEX' in plan[0][3]
+    with pytest.raises(ValueError):
+        User.filter(missing=1)
+    with pytest.raises(ValueError):
+        User.filter(username__contains='x')
+    User(username='\ud7ffx')
+    assert names(User.filter(username__startswith='\ud7ff')) == ['\ud7ffx']
+    with pytest.raises(ValueError, match='username__startswith'):
+        User.filter(username__startswith=1)
+
+
+def test_only_and_defer_select_fewer_columns(models):
+    User, Post = models
+    user = User(username='dori', email='dori@example.com')
+    Post.bulk_create(
+        {'title': f'post {number}', 'body': 'long ' * 100, 'author': user.id}
+        for number in range(3)
+    )
+    posts = list(Post.all().defer('body'))
+    assert Post.queries().splitlines()[-1].startswith(
+        'SELECT post.id, post.title, post.author, post.like_count FROM post'
+    )
+    assert [post.title for post in posts] == ['post 0', 'post 1', 'post 2']
+    assert 'body' not in posts[0].data
+    queries = len(Post.queries().split('\n\n'))
+    assert posts[0].body == 'long ' * 100
+    assert posts[0].body == 'long ' * 100
+    assert len(Post.queries().split('\n\n')) == queries + 1
+    posts[1].update(body='short')
+    assert posts[1].body == 'short'
+    assert Post.filter(id=2).first().body == 'short'
+    post = Post.filter(id=3).only('title').select_related('author').first()
+    assert post._fields == ('id', 'title')
+    assert post.related('author').username == 'dori'
+    assert post.like_count == 0
+    with pytest.raises(ValueError):
+        Post.all().defer('id')
+    with pytest.raises(ValueError):
+        Post.all().only('missing')
+
+
+def test_blobs_stream_in_chunks_with_range_requests(tmp_path, monkeypatch):
+    import io
+    from requests import Session
+    from wsgiadapter import WSGIAdapter
+    from pirouz import App, BlobResponse
+
+    monkeypatch.chdir(tmp_path)
+
+    class Attachment(DB):
+        name = columns.Text()
+        content = columns.Blob()
+
+    data = bytes(range(256)) * 1000
+    attachment = Attachment(name='data.bin')
+    assert Attachment.write_blob(
+        'content', attachment.id, io.BytesIO(data), size=len(data),
+        chunk_size=1000,
+    ) == len(data)
+    assert Attachment.blob_size('content', attachment.id) == len(data)
+    chunks = list(Attachment.read_blob(
+        'content', attachment.id, 10, 50010, chunk_size=4096,
+    ))
+    assert max(len(chunk) for chunk in chunks) == 4096
+    assert b''.join(chunks) == data[10:50010]
+    with pytest.raises(ValueError):
+        Attachment.write_blob('name', attachment.id, b'x')
+    with pytest.raises(ValueError):
+        Attachment.write_blob('content', 99, b'x')
+
+    app = App(__file__)
+
+    @app.route('/files/<int:id>/')
+    def download(request, id):
+        return BlobResponse(request, Attachment, 'content', id)
+
+    client = Session()
+    client.mount('http://testserver', WSGIAdapter(app))
+    response = client.get('http://testserver/files/1/')
+    assert response.status_code == 200
+    assert response.headers['Accept-Ranges'] == 'bytes'
+    assert response.content == data
+    response = client.get(
+        'http://testserver/files/1/', headers={'Range': 'bytes=100-199'},
+    )
+    assert response.status_code == 206
+    assert response.headers['Content-Range'] == f'bytes 100-199/{len(data)}'
+    assert response.content == data[100:200]
+    response = client.get(
+        'http://testserver/files/1/', headers={'Range': 'bytes=-10'},
+    )
+    assert response.content == data[-10:]
+    response = client.get(
+        'http://testserver/files/1/',
+        headers={'Range': f'bytes={len(data)}-'},
+    )
+    assert response.status_code == 416
+    assert client.get('http://testserver/files/2/').status_code == 404
+    assert connections.stats(Attachment.db_name).in_use == 0
+    connections.close_all()
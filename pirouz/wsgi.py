@@ -7,6 +7,7 @@ from werkzeug.middleware.shared_data import SharedDataMiddleware
 from werkzeug.serving import run_simple
 
 from .middleware import BaseMiddleware
+from .orm.connection import connections
 from .response import TextResponse
 
 
@@ -20,6 +21,7 @@ class App():
         },
         'host': '127.0.0.1',
         'port': 8000,
+        'database': {},
     }
 
     def __init__(self, filename, production=False):
@@ -33,6 +35,9 @@ class App():
             self.ROOT_DIR = os.path.dirname(filename)
         if production:
             self.config['debug'] = False
+        database = self.config.get('database')
+        if database:
+            connections.configure(**database)
 
     def set_export_dirs(self, export_dirs: dict):
         export_dirs = export_dirs.copy()
@@ -40,6 +45,10 @@ class App():
             export_dirs[url] = os.path.join(self.ROOT_DIR, dir)
         self.config['export_dirs'] = export_dirs
 
+    def set_database(self, **options):
+        self.config['database'] = options
+        connections.configure(**options)
+
     def __call__(self, environ, start_response):
         return self.middleware(environ, start_response)
 
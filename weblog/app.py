@@ -4,7 +4,7 @@ from datetime import datetime
 from pirouz import (
     App, BaseMiddleware,
     Render as Render_, TextResponse, redirect,
-    DB, ResultConfig, columns, OR
+    DB, ResultConfig, columns
 )
 from pirouz.utils import cleaned_data, encrypt
 
@@ -17,15 +17,18 @@ class User(DB):
     email = columns.Text()
     first_name = columns.VarChar()
     last_name = columns.VarChar()
+    memory_replica = True
 
 
 class Post(DB):
     title = columns.Text(nullable=False)
     body = columns.Text()
-    author = columns.ForeignKey(User)
+    author = columns.ForeignKey(User, index=True)
     like_count = columns.SmallInt(default=0)
     created = columns.Date()
 
+    search_fields = ('title', 'body')
+
 
 class AuthMiddleware(BaseMiddleware):
     def process_request(self, request):
@@ -55,13 +58,17 @@ class Render(Render_):
 
 @app.route('/')
 def index(request):
+    config = ResultConfig(limit=10, order_by='id', reverse=True)
+    try:
+        posts = Post.all(
+            config=config._replace(after=request.args.get('after')),
+        ).defer('body')
+    except ValueError:
+        # a tampered or stale cursor starts over from the first page
+        posts = Post.all(config=config).defer('body')
     context = {
-        'posts': Post.all(
-            config=ResultConfig(
-                order_by='id',
-                reverse=True,
-            )
-        ),
+        'posts': posts,
+        'next_cursor': posts.next_cursor,
     }
     return Render(request, 'post/list.html', context=context)
 
@@ -131,12 +138,12 @@ class Register:
 @app.route('/post/<int:id>/')
 class PostDetail:
     def get(self, request, id):
-        post = Post.filter(id=id).first()
+        post = Post.filter(id=id).select_related('author').first()
         if not post:
             return TextResponse(f'Post with ID {id} not found!', status=404)
         context = {
             'post': post,
-            'author': User.filter(id=post.author).first(),
+            'author': post.related('author'),
         }
         return Render(request, 'post/detail.html', context=context)
 
@@ -168,21 +175,12 @@ class PostCreate:
 @app.route('/search/')
 class Search:
     def get(self, request):
-        query = request.args.get('search')
+        query = request.args.get('search', '').strip()
         context = {
             'search': True,
         }
         if query:
-            posts = Post.filter(
-                OR(
-                    title__like=f'%{query}%',
-                    body__like=f'%{query}%',
-                ),
-                config=ResultConfig(
-                    order_by='id',
-                    reverse=True,
-                )
-            )
+            posts = Post.search(query)
             context.update({
                 'posts': posts,
             })